@@ -9,7 +9,6 @@ np.seterr(divide='ignore', invalid='ignore', over='ignore')
 from coffea.arrays import Initialize
 from coffea import hist, processor
 from coffea.util import load, save
-from coffea.jetmet_tools import FactorizedJetCorrector, JetCorrectionUncertainty, JetTransformer, JetResolution, JetResolutionScaleFactor
 from optparse import OptionParser
 from uproot_methods import TVector2Array, TLorentzVectorArray
 
@@ -49,7 +48,7 @@ class AnalysisProcessor(processor.ProcessorABC):
     }
 
             
-    def __init__(self, year, xsec, corrections, ids, common):
+    def __init__(self, year, xsec, corrections, ids, common, dtype='float64', staged=False):
 
         self._columns = """                                                                                                                    
         MET_pt
@@ -133,6 +132,24 @@ class AnalysisProcessor(processor.ProcessorABC):
         
         self._year = year
 
+        ###
+        # Precision of the quantities the processor stores per event: the event weights
+        # and their variations, the msd correction, the corrected and JES/JER shifted
+        # AK4 and AK15 pt and mass, the dilepton columns and the min dphi. Lookups and the jet
+        # corrector evaluate in float64, their outputs are cast when stored. NanoAOD
+        # kinematics, and the MET and recoil vectors built from them, are float32 in
+        # both modes. Histograms always accumulate in float64
+        ###
+
+        self._dtype = np.dtype(dtype)
+
+        ###
+        # Staged processing: events failing a cheap preselection implied by every region
+        # are dropped before any object is built
+        ###
+
+        self._staged = staged
+
         self._lumi = 1000.*float(AnalysisProcessor.lumis[year])
 
         self._xsec = xsec
@@ -266,17 +283,35 @@ class AnalysisProcessor(processor.ProcessorABC):
             ]
         }
 
+        ###
+        # Jet correctors are built once here rather than in every process() call. The AK15s
+        # are corrected with the AK8PFPuppi version of the same sets
+        ###
+
+        self._jet_corrector = corrections['JetCorrector'](
+            corrections['Jetevaluator'],
+            self._jec[year],
+            self._junc[year],
+            self._jr[year],
+            self._jersf[year]
+        )
+        self._fatjet_corrector = corrections['JetCorrector'](
+            corrections['Jetevaluator'],
+            *[[name.replace('AK4PFPuppi','AK8PFPuppi') for name in names[year]] for names in [self._jec, self._junc, self._jr, self._jersf]]
+        )
+
         self._corrections = corrections
         self._ids = ids
         self._common = common
 
-        self._accumulator = processor.dict_accumulator({
-            'sumw': hist.Hist(
+        DenseHist = common['DenseHist']
+        self._accumulator = common['DenseOutput']({
+            'sumw': DenseHist(
                 'sumw', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Bin('sumw', 'Weight value', [0.])
             ),
-            'CaloMinusPfOverRecoil': hist.Hist(
+            'CaloMinusPfOverRecoil': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -284,7 +319,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('CaloMinusPfOverRecoil','Calo - Pf / Recoil',35,0,1)
             ),
-            'recoil': hist.Hist(
+            'recoil': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -292,7 +327,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'), 
                 hist.Bin('recoil','Hadronic Recoil',[250.0, 280.0, 310.0, 340.0, 370.0, 400.0, 430.0, 470.0, 510.0, 550.0, 590.0, 640.0, 690.0, 740.0, 790.0, 840.0, 900.0, 960.0, 1020.0, 1090.0, 1160.0, 1250.0])
             ),
-            'met': hist.Hist(
+            'met': DenseHist(
             'Events',
                 hist.Cat('dataset', 'Dataset'),
                 hist.Cat('region', 'Region'),
@@ -300,7 +335,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('met','MET',30,0,600)
             ),
-            'mindphi': hist.Hist(
+            'mindphi': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -308,7 +343,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('mindphi','Min dPhi(MET,AK4s)',30,0,3.5)
             ),
-            'j1pt': hist.Hist(
+            'j1pt': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -316,7 +351,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('j1pt','AK4 Leading Jet Pt',[30.0, 60.0, 90.0, 120.0, 150.0, 180.0, 210.0, 250.0, 280.0, 310.0, 340.0, 370.0, 400.0, 430.0, 470.0, 510.0, 550.0, 590.0, 640.0, 690.0, 740.0, 790.0, 840.0, 900.0, 960.0, 1020.0, 1090.0, 1160.0, 1250.0])
             ),
-            'j1eta': hist.Hist(
+            'j1eta': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -324,7 +359,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('j1eta','AK4 Leading Jet Eta',35,-3.5,3.5)
             ),
-            'j1phi': hist.Hist(
+            'j1phi': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -332,7 +367,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('j1phi','AK4 Leading Jet Phi',35,-3.5,3.5)
             ),
-            'fj1pt': hist.Hist(
+            'fj1pt': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -340,7 +375,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('fj1pt','AK15 Leading Jet Pt',[200.0, 250.0, 280.0, 310.0, 340.0, 370.0, 400.0, 430.0, 470.0, 510.0, 550.0, 590.0, 640.0, 690.0, 740.0, 790.0, 840.0, 900.0, 960.0, 1020.0, 1090.0, 1160.0, 1250.0])
             ),
-            'fj1eta': hist.Hist(
+            'fj1eta': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -348,7 +383,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('fj1eta','AK15 Leading Jet Eta',35,-3.5,3.5)
             ),
-            'fj1phi': hist.Hist(
+            'fj1phi': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -356,7 +391,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('fj1phi','AK15 Leading Jet Phi',35,-3.5,3.5)
             ),
-            'njets': hist.Hist(
+            'njets': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -364,7 +399,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('njets','AK4 Number of Jets',6,-0.5,5.5)
             ),
-            'ndcsvL': hist.Hist(
+            'ndcsvL': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -372,7 +407,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('ndcsvL','AK4 Number of deepCSV Loose Jets',6,-0.5,5.5)
             ),
-            'ndflvL': hist.Hist(
+            'ndflvL': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -380,7 +415,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('ndflvL','AK4 Number of deepFlavor Loose Jets',6,-0.5,5.5)
             ),
-            'nfjclean': hist.Hist(
+            'nfjclean': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -388,7 +423,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('nfjclean','AK15 Number of cleaned Jets',4,-0.5,3.5)
             ),
-            'fjmass': hist.Hist(
+            'fjmass': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -396,7 +431,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('fjmass','AK15 Jet Mass',30,0,300)
             ),
-            'e1pt': hist.Hist(
+            'e1pt': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -404,7 +439,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('e1pt','Leading Electron Pt',[30.0, 60.0, 90.0, 120.0, 150.0, 180.0, 210.0, 250.0, 280.0, 310.0, 340.0, 370.0, 400.0, 430.0, 470.0, 510.0, 550.0, 590.0, 640.0, 690.0, 740.0, 790.0, 840.0, 900.0, 960.0, 1020.0, 1090.0, 1160.0, 1250.0])
             ),
-            'e1eta': hist.Hist(
+            'e1eta': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -412,7 +447,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('e1eta','Leading Electron Eta',48,-2.4,2.4)
             ),
-            'e1phi': hist.Hist(
+            'e1phi': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -420,7 +455,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('e1phi','Leading Electron Phi',64,-3.2,3.2)
             ),
-            'dielemass': hist.Hist(
+            'dielemass': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -428,7 +463,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('dielemass','Dielectron mass',100,0,500)
             ),
-            'dielept': hist.Hist(
+            'dielept': DenseHist(
                 'Events',
                 hist.Cat('dataset', 'Dataset'),
                 hist.Cat('region', 'Region'),
@@ -436,7 +471,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('dielept','Dielectron Pt',150,0,800)
             ),
-            'mu1pt': hist.Hist(
+            'mu1pt': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -444,7 +479,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('mu1pt','Leading Muon Pt',[30.0, 60.0, 90.0, 120.0, 150.0, 180.0, 210.0, 250.0, 280.0, 310.0, 340.0, 370.0, 400.0, 430.0, 470.0, 510.0, 550.0, 590.0, 640.0, 690.0, 740.0, 790.0, 840.0, 900.0, 960.0, 1020.0, 1090.0, 1160.0, 1250.0])
             ),
-            'mu1eta': hist.Hist(
+            'mu1eta': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -452,7 +487,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('mu1eta','Leading Muon Eta',48,-2.4,2.4)
             ),
-            'mu1phi': hist.Hist(
+            'mu1phi': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -460,7 +495,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('mu1phi','Leading Muon Phi',64,-3.2,3.2)
             ),
-            'dimumass': hist.Hist(
+            'dimumass': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -468,7 +503,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('dimumass','Dimuon mass',100,0,500)
             ),
-            'dimupt': hist.Hist(
+            'dimupt': DenseHist(
                 'Events',
                 hist.Cat('dataset', 'Dataset'),
                 hist.Cat('region', 'Region'),
@@ -476,7 +511,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 hist.Cat('gentype', 'Gen Type'),
                 hist.Bin('dimupt','Dimuon Pt',150,0,800)
             ),
-            'ZHbbvsQCD': hist.Hist(
+            'ZHbbvsQCD': DenseHist(
                 'Events', 
                 hist.Cat('dataset', 'Dataset'), 
                 hist.Cat('region', 'Region'), 
@@ -505,10 +540,72 @@ class AnalysisProcessor(processor.ProcessorABC):
                 selected_regions.append(region)
 
         isData = 'genWeight' not in events.columns
-        selection = processor.PackedSelection()
         weights = {}
         hout = self.accumulator.identity()
 
+        ###
+        # JEC/JER of the AK4s and the AK15s as jagged columns: corrected pt and mass, and the
+        # JES/JER shifted pt and mass for the variations. The AK15s have no gen jet link and
+        # are smeared stochastically, the cone size is a seed word so that the AK4 and AK15
+        # with the same index do not share their random number
+        ###
+
+        def corrected(events, collection, corrector, cone):
+            j = events[collection]
+            ptGenJet = j.matched_gen.pt.fillna(0.) if collection == 'Jet' else j.pt.zeros_like()
+            rho = j.pt.ones_like()*np.asarray(events.fixedGridRhoFastjetAll)
+            seed = np.stack([np.repeat(np.asarray(events[column]), j.counts).astype(np.uint64) for column in ['run', 'luminosityBlock', 'event']]+[j.localindex.flatten().astype(np.uint64), np.full(j.counts.sum(), cone, dtype=np.uint64)], axis=1)
+            out = corrector.corrected(*[np.asarray(column.flatten()) for column in [j.pt*(1-j.rawFactor), j.mass*(1-j.rawFactor), j.eta, j.area, rho, ptGenJet]], seed)
+            return {column: awkward.JaggedArray.fromcounts(j.counts, values) for column, values in out.items()}
+
+        def corrected_jets(events): return corrected(events, 'Jet', self._jet_corrector, 4)
+        def corrected_fatjets(events): return corrected(events, 'AK15Puppi', self._fatjet_corrector, 15)
+
+        variations = [] if isData else ['jesUp','jesDown','jerUp','jerDown']
+        jets_corrected, fatjets_corrected = None, None
+
+        ###
+        # The sum of generator weights is taken over the full chunk. In staged mode the chunk
+        # is then compacted to the events passing the MET filters, any of the triggers, an
+        # AK15 above the fat jet threshold and a recoil upper bound (MET plus the scalar sum
+        # of all the electrons, muons and photons) above 200 GeV, looser than every region.
+        # In MC the MET and the AK15 pt of these cuts are the largest among the nominal and
+        # the JES/JER shifted ones. Correcting the jets is the expensive part, so it only runs
+        # on the events passing a first version of the cuts where every jet may move by
+        # jet_shift times its stored pt, well beyond the JES uncertainty and the JER smearing:
+        # the MET moves by at most the sum of the shifts of the AK4s
+        ###
+
+        if not isData: sumw = events.genWeight.sum()
+        if self._staged:
+            preselection = np.ones(events.size, dtype=bool)
+            for flag in AnalysisProcessor.met_filter_flags[self._year]:
+                preselection = preselection & events.Flag[flag]
+            triggers = np.zeros(events.size, dtype=bool)
+            for path in self._met_triggers[self._year]+self._singleelectron_triggers[self._year]+self._singlephoton_triggers[self._year]:
+                if path not in events.HLT.columns: continue
+                triggers = triggers | events.HLT[path]
+            jet_shift = 0. if isData else 0.5
+            lepton_pt = events.Electron.pt.sum() + events.Muon.pt.sum() + events.Photon.pt.sum()
+            recoil_bound = events.MET.pt + jet_shift*events.Jet.pt.sum() + lepton_pt
+            preselection = preselection & triggers & (events.AK15Puppi.pt*(1+jet_shift)>160).any() & (recoil_bound>200)
+            events = events[preselection]
+            if not isData:
+                lepton_pt = lepton_pt[preselection]
+                jets_corrected, fatjets_corrected = corrected_jets(events), corrected_fatjets(events)
+                met_T = TVector2Array.from_polar(events.MET.pt, events.MET.phi)
+                phi = events.Jet.phi
+                met_bound = np.asarray(events.MET.pt)
+                fj_bound = fatjets_corrected['pt']
+                for v in variations:
+                    dpt = (jets_corrected['pt_'+v] - jets_corrected['pt'])*(jets_corrected['pt']>15)
+                    met_bound = np.maximum(met_bound, np.hypot(met_T.x - (dpt*np.cos(phi)).sum(), met_T.y - (dpt*np.sin(phi)).sum()))
+                    fj_bound = np.maximum(fj_bound, fatjets_corrected['pt_'+v])
+                preselection = (fj_bound>160).any() & (met_bound + lepton_pt>200)
+                events = events[preselection]
+                jets_corrected = {column: values[preselection] for column, values in jets_corrected.items()}
+                fatjets_corrected = {column: values[preselection] for column, values in fatjets_corrected.items()}
+
         ###
         #Getting corrections, ids from .coffea files
         ###
@@ -522,47 +619,37 @@ class AnalysisProcessor(processor.ProcessorABC):
         get_pu_weight           = self._corrections['get_pu_weight'][self._year]          
         get_met_trig_weight     = self._corrections['get_met_trig_weight'][self._year]    
         get_met_zmm_trig_weight = self._corrections['get_met_zmm_trig_weight'][self._year]
-        get_ele_trig_weight     = self._corrections['get_ele_trig_weight'][self._year]    
         get_pho_trig_weight     = self._corrections['get_pho_trig_weight'][self._year]    
-        get_ele_loose_id_sf     = self._corrections['get_ele_loose_id_sf'][self._year]
-        get_ele_tight_id_sf     = self._corrections['get_ele_tight_id_sf'][self._year]
-        get_ele_loose_id_eff    = self._corrections['get_ele_loose_id_eff'][self._year]
-        get_ele_tight_id_eff    = self._corrections['get_ele_tight_id_eff'][self._year]
         get_pho_tight_id_sf     = self._corrections['get_pho_tight_id_sf'][self._year]
-        get_mu_tight_id_sf      = self._corrections['get_mu_tight_id_sf'][self._year]
-        get_mu_loose_id_sf      = self._corrections['get_mu_loose_id_sf'][self._year]
-        get_ele_reco_sf         = self._corrections['get_ele_reco_sf'][self._year]
-        get_mu_tight_iso_sf     = self._corrections['get_mu_tight_iso_sf'][self._year]
-        get_mu_loose_iso_sf     = self._corrections['get_mu_loose_iso_sf'][self._year]
+        get_lepton_weights      = self._corrections['get_lepton_weights'][self._year]
         get_ecal_bad_calib      = self._corrections['get_ecal_bad_calib']
-        get_deepflav_weight     = self._corrections['get_btag_weight']['deepflav'][self._year]
-        Jetevaluator            = self._corrections['Jetevaluator']
+        get_deepflav_weights    = self._corrections['get_btag_weights']['deepflav'][self._year]
         
-        isLooseElectron = self._ids['isLooseElectron'] 
-        isTightElectron = self._ids['isTightElectron'] 
-        isLooseMuon     = self._ids['isLooseMuon']     
-        isTightMuon     = self._ids['isTightMuon']     
+        electronIDs     = self._ids['electronIDs']
+        muonIDs         = self._ids['muonIDs']
         isLooseTau      = self._ids['isLooseTau']      
-        isLoosePhoton   = self._ids['isLoosePhoton']   
-        isTightPhoton   = self._ids['isTightPhoton']   
+        photonIDs       = self._ids['photonIDs']
         isGoodJet       = self._ids['isGoodJet']       
         isGoodFatJet    = self._ids['isGoodFatJet']    
         isHEMJet        = self._ids['isHEMJet']        
         
         match = self._common['match']
+        vetoes = self._common['vetoes']
+        clean = self._common['clean']
+        leading_pair = self._common['leading_pair']
+        min_dphi = self._common['min_dphi']
+        pack_flags = self._common['pack_flags']
+        has_flags = self._common['has_flags']
+        gen_ancestry = self._common['gen_ancestry']
+        fatjet_gen_labels = self._common['fatjet_gen_labels']
+        HistFiller = self._common['HistFiller']
+        weight_matrix = self._common['weight_matrix']
+        Weights = self._common['Weights']
+        dtype = self._dtype
+        SelectionPlan = self._common['SelectionPlan']
         deepflavWPs = self._common['btagWPs']['deepflav'][self._year]
         deepcsvWPs = self._common['btagWPs']['deepcsv'][self._year]
 
-        ###
-        # Derive jet corrector for JEC/JER
-        ###
-        
-        JECcorrector = FactorizedJetCorrector(**{name: Jetevaluator[name] for name in self._jec[self._year]})
-        JECuncertainties = JetCorrectionUncertainty(**{name:Jetevaluator[name] for name in self._junc[self._year]})
-        JER = JetResolution(**{name:Jetevaluator[name] for name in self._jr[self._year]})
-        JERsf = JetResolutionScaleFactor(**{name:Jetevaluator[name] for name in self._jersf[self._year]})
-        Jet_transformer = JetTransformer(jec=JECcorrector,junc=JECuncertainties, jer = JER, jersf = JERsf)
-        
         ###
         #Initialize global quantities (MET ecc.)
         ###
@@ -577,264 +664,214 @@ class AnalysisProcessor(processor.ProcessorABC):
         ###
 
         e = events.Electron
-        e['isloose'] = isLooseElectron(e.pt,e.eta,e.dxy,e.dz,e.cutBased,self._year)
-        e['istight'] = isTightElectron(e.pt,e.eta,e.dxy,e.dz,e.cutBased,self._year)
+        isloose, istight = electronIDs(e.pt,e.eta,e.dxy,e.dz,e.cutBased,self._year)
+        e['flags'] = pack_flags(isloose=isloose, istight=istight)
         e['T'] = TVector2Array.from_polar(e.pt, e.phi)
         #e['p4'] = TLorentzVectorArray.from_ptetaphim(e.pt, e.eta, e.phi, e.mass)
-        e_loose = e[e.isloose.astype(np.bool)]
-        e_tight = e[e.istight.astype(np.bool)]
+        e_loose = e[has_flags(e.flags,'isloose')]
         e_ntot = e.counts
         e_nloose = e_loose.counts
-        e_ntight = e_tight.counts
+        e_ntight = has_flags(e.flags,'istight').sum()
         leading_e = e[e.pt.argmax()]
-        leading_e = leading_e[leading_e.istight.astype(np.bool)]
+        leading_e = leading_e[has_flags(leading_e.flags,'istight')]
 
         mu = events.Muon
-        mu['isloose'] = isLooseMuon(mu.pt,mu.eta,mu.pfRelIso04_all,mu.looseId,self._year)
-        mu['istight'] = isTightMuon(mu.pt,mu.eta,mu.pfRelIso04_all,mu.tightId,self._year)
+        isloose, istight = muonIDs(mu.pt,mu.eta,mu.pfRelIso04_all,mu.looseId,mu.tightId,self._year)
+        mu['flags'] = pack_flags(isloose=isloose, istight=istight)
         mu['T'] = TVector2Array.from_polar(mu.pt, mu.phi)
         #mu['p4'] = TLorentzVectorArray.from_ptetaphim(mu.pt, mu.eta, mu.phi, mu.mass)
-        mu_loose=mu[mu.isloose.astype(np.bool)]
-        mu_tight=mu[mu.istight.astype(np.bool)]
+        mu_loose=mu[has_flags(mu.flags,'isloose')]
         mu_ntot = mu.counts
         mu_nloose = mu_loose.counts
-        mu_ntight = mu_tight.counts
+        mu_ntight = has_flags(mu.flags,'istight').sum()
         leading_mu = mu[mu.pt.argmax()]
-        leading_mu = leading_mu[leading_mu.istight.astype(np.bool)]
+        leading_mu = leading_mu[has_flags(leading_mu.flags,'istight')]
 
         tau = events.Tau
-        tau['isclean']=~match(tau,mu_loose,0.5)&~match(tau,e_loose,0.5)
-        tau['isloose']=isLooseTau(tau.pt,tau.eta,tau.idDecayMode,tau.idMVAoldDM2017v2,self._year)
-        tau_clean=tau[tau.isclean.astype(np.bool)]
-        tau_loose=tau_clean[tau_clean.isloose.astype(np.bool)]
+        lepton_veto = vetoes([(mu_loose,0.5),(e_loose,0.5)])
+        tau['flags'] = pack_flags(
+            isclean=clean(tau,lepton_veto),
+            isloose=isLooseTau(tau.pt,tau.eta,tau.idDecayMode,tau.idMVAoldDM2017v2,self._year)
+        )
         tau_ntot=tau.counts
-        tau_nloose=tau_loose.counts
+        tau_nloose=has_flags(tau.flags,'isclean','isloose').sum()
 
         pho = events.Photon
-        pho['isclean']=~match(pho,mu_loose,0.5)&~match(pho,e_loose,0.5)
         _id = 'cutBasedBitmap'
         if self._year=='2016': _id = 'cutBased'
-        pho['isloose']=isLoosePhoton(pho.pt,pho.eta,pho[_id],self._year)
-        pho['istight']=isTightPhoton(pho.pt,pho.eta,pho[_id],self._year)
+        isloose, istight = photonIDs(pho.pt,pho.eta,pho[_id],self._year)
+        pho['flags'] = pack_flags(isclean=clean(pho,lepton_veto), isloose=isloose, istight=istight)
         pho['T'] = TVector2Array.from_polar(pho.pt, pho.phi)
         #pho['p4'] = TLorentzVectorArray.from_ptetaphim(pho.pt, pho.eta, pho.phi, pho.mass)
-        pho_clean=pho[pho.isclean.astype(np.bool)]
-        pho_loose=pho_clean[pho_clean.isloose.astype(np.bool)]
-        pho_tight=pho_clean[pho_clean.istight.astype(np.bool)]
+        pho_loose=pho[has_flags(pho.flags,'isclean','isloose')]
         pho_ntot=pho.counts
         pho_nloose=pho_loose.counts
-        pho_ntight=pho_tight.counts
+        pho_ntight=has_flags(pho.flags,'isclean','istight').sum()
         leading_pho = pho[pho.pt.argmax()]
-        leading_pho = leading_pho[leading_pho.isclean.astype(np.bool)]
-        leading_pho = leading_pho[leading_pho.istight.astype(np.bool)]
+        leading_pho = leading_pho[has_flags(leading_pho.flags,'isclean','istight')]
 
         sj = events.AK15PuppiSubJet
         sj['p4'] = TLorentzVectorArray.from_ptetaphim(sj.pt, sj.eta, sj.phi, sj.mass)
 
         fj = events.AK15Puppi
+        if not isData:
+            ###
+            # JEC/JER: as for the AK4s below, with the AK8PFPuppi set
+            ###
+            if fatjets_corrected is None: fatjets_corrected = corrected_fatjets(events)
+            for column, values in fatjets_corrected.items():
+                fj[column] = awkward.JaggedArray.fromcounts(fj.counts, np.asarray(values.flatten()).astype(dtype))
         fj['hassj1'] = (fj.subJetIdx1>-1)
         fj['hassj2'] = (fj.subJetIdx2>-1)
-        fj['isgood'] = isGoodFatJet(fj.pt, fj.eta, fj.jetId)
-        fj['isclean'] =~match(fj,pho_loose,1.5)&~match(fj,mu_loose,1.5)&~match(fj,e_loose,1.5)
-        fj['msd_corr'] = fj.msoftdrop*awkward.JaggedArray.fromoffsets(fj.array.offsets, get_msd_weight(fj.pt.flatten(),fj.eta.flatten()))
+        fj['flags'] = pack_flags(
+            isclean=clean(fj,vetoes([(pho_loose,1.5),(mu_loose,1.5),(e_loose,1.5)]))
+        )
         fj['ZHbbvsQCD'] = (fj.probZbb + fj.probHbb) / (fj.probZbb+ fj.probHbb+ fj.probQCDbb+fj.probQCDcc+fj.probQCDb+fj.probQCDc+fj.probQCDothers)
-        fj_good = fj[fj.isgood.astype(np.bool)]
-        fj_clean=fj_good[fj_good.isclean.astype(np.bool)]
         fj_ntot=fj.counts
-        fj_ngood=fj_good.counts
-        fj_nclean=fj_clean.counts
 
         j = events.Jet
-        j['isgood'] = isGoodJet(j.pt, j.eta, j.jetId, j.neHEF, j.neEmEF, j.chHEF, j.chEmEF)
-        j['isHEM'] = isHEMJet(j.pt, j.eta, j.phi)
-        j['isclean'] = ~match(j,e_loose,0.4)&~match(j,mu_loose,0.4)&~match(j,pho_loose,0.4)
-        j['isiso'] = ~match(j,fj_clean,1.5)
-        j['isdcsvL'] = (j.btagDeepB>deepcsvWPs['loose'])
-        j['isdflvL'] = (j.btagDeepFlavB>deepflavWPs['loose'])
+        if not isData:
+            ###
+            # JEC/JER: pt and mass are replaced by the corrected ones before any selection,
+            # the JES/JER shifted pt and mass are kept as columns for the variations
+            ###
+            if jets_corrected is None: jets_corrected = corrected_jets(events)
+            for column, values in jets_corrected.items():
+                j[column] = awkward.JaggedArray.fromcounts(j.counts, np.asarray(values.flatten()).astype(dtype))
         j['T'] = TVector2Array.from_polar(j.pt, j.phi)
         j['p4'] = TLorentzVectorArray.from_ptetaphim(j.pt, j.eta, j.phi, j.mass)
-        j['ptRaw'] =j.pt * (1-j.rawFactor)
-        j['massRaw'] = j.mass * (1-j.rawFactor)
-        j['rho'] = j.pt.ones_like()*events.fixedGridRhoFastjetAll.array
-        j_good = j[j.isgood.astype(np.bool)]
-        j_clean = j_good[j_good.isclean.astype(np.bool)]
-        j_iso = j_clean[j_clean.isiso.astype(np.bool)]
-        j_dcsvL = j_iso[j_iso.isdcsvL.astype(np.bool)]
-        j_dflvL = j_iso[j_iso.isdflvL.astype(np.bool)]
-        j_HEM = j[j.isHEM.astype(np.bool)]
+        j_flags = pack_flags(
+            isclean=clean(j,vetoes([(e_loose,0.4),(mu_loose,0.4),(pho_loose,0.4)])),
+            isdcsvL=(j.btagDeepB>deepcsvWPs['loose']),
+            isdflvL=(j.btagDeepFlavB>deepflavWPs['loose'])
+        )
         j_ntot=j.counts
-        j_ngood=j_good.counts
-        j_nclean=j_clean.counts
-        j_niso=j_iso.counts
-        j_ndcsvL=j_dcsvL.counts
-        j_ndflvL=j_dflvL.counts
-        j_nHEM = j_HEM.counts
-        leading_j = j[j.pt.argmax()]
-        leading_j = leading_j[leading_j.isgood.astype(np.bool)]
-        leading_j = leading_j[leading_j.isclean.astype(np.bool)]
 
         ###
         #Calculating derivatives
         ###
 
-        ele_pairs = e_loose.distincts()
-        diele = ele_pairs.i0+ele_pairs.i1
-        diele['T'] = TVector2Array.from_polar(diele.pt, diele.phi)
-        leading_ele_pair = ele_pairs[diele.pt.argmax()]
-        leading_diele = diele[diele.pt.argmax()]
+        leading_diele = leading_pair(e_loose, dtype)
+        leading_diele['T'] = TVector2Array.from_polar(leading_diele.pt, leading_diele.phi)
 
-        mu_pairs = mu_loose.distincts()
-        dimu = mu_pairs.i0+mu_pairs.i1
-        dimu['T'] = TVector2Array.from_polar(dimu.pt, dimu.phi)
-        leading_mu_pair = mu_pairs[dimu.pt.argmax()]
-        leading_dimu = dimu[dimu.pt.argmax()]
+        leading_dimu = leading_pair(mu_loose, dtype)
+        leading_dimu['T'] = TVector2Array.from_polar(leading_dimu.pt, leading_dimu.phi)
 
         ###
-        # Calculate recoil
+        # Everything downstream of the AK4 and AK15 pt: the pt-dependent jet flags, the AK4
+        # isolation from the clean AK15s, the leading AK15 and its corrected soft-drop mass,
+        # the MET and the recoil built on it. Cleaning and b-tagging flags do not depend on
+        # the pt and are computed once above, a JES/JER variation only reruns this pass
         ###
 
-        um = met.T+leading_mu.T.sum()
-        ue = met.T+leading_e.T.sum()
-        umm = met.T+leading_dimu.T.sum()
-        uee = met.T+leading_diele.T.sum()
-        ua = met.T+leading_pho.T.sum()
-
-        u = {}
-        u['sr']=met.T
-        u['wecr']=ue
-        u['tecr']=ue
-        u['wmcr']=um
-        u['tmcr']=um
-        u['zecr']=uee
-        u['zmcr']=umm
-        u['gcr']=ua
-
-        ###
-        #Calculating weights
-        ###
-        if not isData:
-            
+        def jet_pass(pt, fj_pt, met_T, met_pt):
+            jp = {}
+            jp['met_pt'] = met_pt
+            fj_flags = fj.flags | pack_flags(isgood=isGoodFatJet(fj_pt, fj.eta, fj.jetId))
+            fj_clean_mask = has_flags(fj_flags,'isgood','isclean')
+            jp['fj_clean_pt'] = fj_pt[fj_clean_mask]
+            jp['fj_ngood'] = has_flags(fj_flags,'isgood').sum()
+            jp['fj_nclean'] = fj_clean_mask.sum()
+            fj_leading = fj_pt.argmax()
+            fj_leading_mask = has_flags(fj_flags[fj_leading],'isgood','isclean')
+            jp['leading_fj'] = (fj_leading, fj_leading_mask)
+            leading_fj = fj[fj_leading][fj_leading_mask]
+            leading_fj_pt = fj_pt[fj_leading][fj_leading_mask]
             ###
-            # JEC/JER
+            # The soft-drop mass follows the relative JES/JER shift of the AK15 pt
             ###
+            jp['leading_fj_pt'] = leading_fj_pt
+            jp['leading_fj_msd_corr'] = leading_fj.msoftdrop*(leading_fj_pt/leading_fj.pt)*awkward.JaggedArray.fromcounts(leading_fj.counts, get_msd_weight(leading_fj_pt.flatten(),leading_fj.eta.flatten()).astype(dtype))
 
-            #j['ptGenJet'] = j.matched_gen.pt
-            #Jet_transformer.transform(j)
-
-            gen = events.GenPart
+            flags = j_flags | pack_flags(
+                isgood=isGoodJet(pt, j.eta, j.jetId, j.neHEF, j.neEmEF, j.chHEF, j.chEmEF),
+                isHEM=isHEMJet(pt, j.eta, j.phi),
+                isiso=~match(j,fj[fj_clean_mask],1.5)
+            )
+            clean_mask = has_flags(flags,'isgood','isclean')
+            iso_mask = has_flags(flags,'isgood','isclean','isiso')
+            jp['j_iso_mask'] = iso_mask
+            jp['j_iso_pt'] = pt[iso_mask]
+            jp['j_nclean'] = clean_mask.sum()
+            jp['j_ndcsvL'] = has_flags(flags,'isgood','isclean','isiso','isdcsvL').sum()
+            jp['j_ndflvL'] = has_flags(flags,'isgood','isclean','isiso','isdflvL').sum()
+            jp['j_nHEM'] = has_flags(flags,'isHEM').sum()
+            leading = pt.argmax()
+            leading_mask = has_flags(flags[leading],'isgood','isclean')
+            jp['leading_j_eta'] = j.eta[leading][leading_mask]
+            jp['leading_j_phi'] = j.phi[leading][leading_mask]
+            jp['leading_j_pt'] = pt[leading][leading_mask]
 
             ###
-            # Fat-jet top matching at decay level
+            # Calculate recoil
             ###
 
-            qFromW = gen[
-                (abs(gen.pdgId) < 5) &
-                gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                (abs(gen.distinctParent.pdgId) == 24)
-            ]
-            def tbqqmatch(topid, dR=1.5):
-                qFromWFromTop = qFromW[qFromW.distinctParent.distinctParent.pdgId == topid]
-                bFromTop = gen[
-                    (abs(gen.pdgId) == 5) &
-                    gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                    (gen.distinctParent.pdgId == topid)
-                ]
-                jetgenWq = fj.cross(qFromWFromTop, nested=True)
-                jetgenb = fj.cross(bFromTop, nested=True)
-                Wmatch = (jetgenWq.i0.delta_r(jetgenWq.i1) < dR).all()&(qFromWFromTop.counts>0)
-                bmatch = (jetgenb.i0.delta_r(jetgenb.i1) < dR).all()&(bFromTop.counts>0)
-                return Wmatch & bmatch
-            fj['isTbqq'] = tbqqmatch(6)|tbqqmatch(-6)
-
-            def tqqmatch(topid, dR=1.5):
-                qFromWFromTop = qFromW[qFromW.distinctParent.distinctParent.pdgId == topid]
-                jetgenWq = fj.cross(qFromWFromTop, nested=True)
-                Wmatch = (jetgenWq.i0.delta_r(jetgenWq.i1) < dR).all()&(qFromWFromTop.counts>0)
-                return Wmatch
-            fj['isTqq'] = tqqmatch(6)|tqqmatch(-6)
-
-            def tbqmatch(topid, dR=1.5):
-                qFromWFromTop = qFromW[qFromW.distinctParent.distinctParent.pdgId == topid]
-                bFromTop = gen[
-                    (abs(gen.pdgId) == 5) &
-                    gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                    (gen.distinctParent.pdgId == topid)
-                ]
-                jetgenWq = fj.cross(qFromWFromTop, nested=True)
-                jetgenb = fj.cross(bFromTop, nested=True)
-                Wmatch = (jetgenWq.i0.delta_r(jetgenWq.i1) < dR).any()&(qFromWFromTop.counts>0)
-                bmatch = (jetgenb.i0.delta_r(jetgenb.i1) < dR).all()&(bFromTop.counts>0)
-                return Wmatch & bmatch
-            fj['isTbq'] = tbqmatch(6)|tbqmatch(-6)
+            um = met_T+leading_mu.T.sum()
+            ue = met_T+leading_e.T.sum()
+            umm = met_T+leading_dimu.T
+            uee = met_T+leading_diele.T
+            ua = met_T+leading_pho.T.sum()
+
+            u = {}
+            u['sr']=met_T
+            u['wecr']=ue
+            u['tecr']=ue
+            u['wmcr']=um
+            u['tmcr']=um
+            u['zecr']=uee
+            u['zmcr']=umm
+            u['gcr']=ua
 
             ###
-            # Fat-jet W->qq matching at decay level
+            # Recoil magnitude and min dphi with the clean AK4s only depend on the base region:
+            # computed once per recoil definition, shared by selection, weights and fills.
+            # The min dphi of all the recoil definitions comes from one pass over the AK4s
             ###
-            jetgenq = fj.cross(qFromW, nested=True)
-            qqmatch = (jetgenq.i0.delta_r(jetgenq.i1) < 1.5).all()&(qFromW.counts>0)
-            fj['isWqq']  = qqmatch
 
-            ###
-            # Fat-jet Z->bb matching at decay level
-            ###
-            bFromZ = gen[
-                (abs(gen.pdgId) == 5) &
-                gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                (abs(gen.distinctParent.pdgId) == 23)
-            ]
-            jetgenb = fj.cross(bFromZ, nested=True)
-            bbmatch = (jetgenb.i0.delta_r(jetgenb.i1) < 1.5).all()&(bFromZ.counts>0)
-            fj['isZbb']  = bbmatch
+            base = {r: next(other for other in u if u[other] is u[r]) for r in u}
+            u_mag = {r: u[r].mag for r in set(base.values())}
+            u_mindphi = min_dphi({r: u[r].phi for r in u_mag}, j.phi[clean_mask], dtype)
+            jp['u_mag'] = {r: u_mag[base[r]] for r in u}
+            jp['u_mindphi'] = {r: u_mindphi[base[r]] for r in u}
+            jp['calominuspf'] = abs(calomet.pt - met_pt)
+            return jp
 
-            ###
-            # Fat-jet Z->qq matching at decay level
-            ###
-            qFromZ = gen[
-                (abs(gen.pdgId) < 5) &
-                gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                (abs(gen.distinctParent.pdgId) == 23)
-            ]
-            jetgenq = fj.cross(qFromZ, nested=True)
-            qqmatch = (jetgenq.i0.delta_r(jetgenq.i1) < 1.5).all()&(qFromZ.counts>0)
-            fj['isZqq']  = qqmatch
+        jets = {None: jet_pass(j.pt, fj.pt, met.T, met.pt)}
 
-            ###
-            # Fat-jet H->bb matching at decay level
-            ###
-            bFromH = gen[
-                (abs(gen.pdgId) == 5) &
-                gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                (abs(gen.distinctParent.pdgId) == 25)
-            ]
-            jetgenb = fj.cross(bFromH, nested=True)
-            bbmatch = (jetgenb.i0.delta_r(jetgenb.i1) < 1.5).all()&(bFromH.counts>0)
-            fj['isHbb']  = bbmatch
+        ###
+        # JES/JER variations shift the AK4s and the AK15s together, the MET follows the
+        # shift of the AK4s above 15 GeV
+        ###
+
+        for v in variations:
+            dpt = (j['pt_'+v] - j.pt)*(j.pt>15)
+            met_T = TVector2Array.from_cartesian(met.T.x - (dpt*np.cos(j.phi)).sum(), met.T.y - (dpt*np.sin(j.phi)).sum())
+            jets[v] = jet_pass(j['pt_'+v], fj['pt_'+v], met_T, met_T.mag)
+
+        ###
+        #Calculating weights
+        ###
+        if not isData:
+            
+            gen = events.GenPart
+            for column, values in gen_ancestry(gen).items():
+                gen[column] = values
+            hardLast = gen.fromHardProcess & gen.isLastCopy
 
             ###
-            # Fat-jet dark H->bb matching at decay level
+            # Fat-jet matching to hard-process partons at decay level, all labels in one pass
             ###
-            bFromHs = gen[
-                (abs(gen.pdgId) == 5) &
-                gen.hasFlags(['fromHardProcess', 'isFirstCopy']) &
-                (abs(gen.distinctParent.pdgId) == 54)
-            ]
-            jetgenb = fj.cross(bFromHs, nested=True)
-            bbmatch = (jetgenb.i0.delta_r(jetgenb.i1) < 1.5).all()&(bFromHs.counts>0)
-            fj['isHsbb']  = bbmatch
 
-            gen['isb'] = (abs(gen.pdgId)==5)&gen.hasFlags(['fromHardProcess', 'isLastCopy'])
-            jetgenb = fj.cross(gen[gen.isb], nested=True)
-            bmatch = ((jetgenb.i0.delta_r(jetgenb.i1) < 1.5).sum()==1)&(gen[gen.isb].counts>0)
-            fj['isb']  = bmatch
+            for label, mask in fatjet_gen_labels(fj, gen).items():
+                fj[label] = mask
 
-            bmatch = ((jetgenb.i0.delta_r(jetgenb.i1) < 1.5).sum()==2)&(gen[gen.isb].counts>0)
-            fj['isbb']  = bmatch
+            gen['isb'] = (abs(gen.pdgId)==5)&hardLast
 
-            gen['isc'] = (abs(gen.pdgId)==4)&gen.hasFlags(['fromHardProcess', 'isLastCopy'])
-            gen['isTop'] = (abs(gen.pdgId)==6)&gen.hasFlags(['fromHardProcess', 'isLastCopy'])
-            gen['isW'] = (abs(gen.pdgId)==24)&gen.hasFlags(['fromHardProcess', 'isLastCopy'])
-            gen['isZ'] = (abs(gen.pdgId)==23)&gen.hasFlags(['fromHardProcess', 'isLastCopy'])
-            gen['isA'] = (abs(gen.pdgId)==22)&gen.hasFlags(['fromHardProcess', 'isLastCopy'])
+            gen['isc'] = (abs(gen.pdgId)==4)&hardLast
+            gen['isTop'] = (abs(gen.pdgId)==6)&hardLast
+            gen['isW'] = (abs(gen.pdgId)==24)&hardLast
+            gen['isZ'] = (abs(gen.pdgId)==23)&hardLast
+            gen['isA'] = (abs(gen.pdgId)==22)&hardLast
 
             genTops = gen[gen.isTop]
             genWs = gen[gen.isW]
@@ -869,141 +906,176 @@ class AnalysisProcessor(processor.ProcessorABC):
             # Calculate PU weight and systematic variations
             ###
 
-            pu = get_pu_weight['cen'](events.PV.npvs)
-            #puUp = get_pu_weight['up'](events.PV.npvs)
-            #puDown = get_pu_weight['down'](events.PV.npvs)
+            pu, puUp, puDown = get_pu_weight(events.PV.npvs)
 
             ###
-            # Trigger efficiency weight
+            # Weight components are defined per region and only evaluated when the
+            # region is selected for this dataset, each of them at most once per chunk
             ###
-            
-            ele1_trig_weight = get_ele_trig_weight(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            ele2_trig_weight = get_ele_trig_weight(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
 
-            trig = {}
-            trig['sr'] = get_met_trig_weight(met.pt)
-            trig['wmcr'] = get_met_trig_weight(um.mag)
-            trig['tmcr'] = trig['wmcr'] 
-            trig['zmcr'] = get_met_zmm_trig_weight(umm.mag)
-            trig['wecr'] = get_ele_trig_weight(leading_e.eta.sum(), leading_e.pt.sum())
-            trig['tecr'] = trig['wecr']
-            trig['zecr'] = 1 - (1-ele1_trig_weight)*(1-ele2_trig_weight)
-            trig['gcr'] = get_pho_trig_weight(leading_pho.pt.sum())
+            def memo(f):
+                cache = []
+                def get():
+                    if not cache: cache.append(f())
+                    return cache[0]
+                return get
+
+            ###
+            # Lepton trigger, ID, reconstruction and isolation tables of each leg are
+            # looked up together, sharing the bin indices of the leg kinematics
+            ###
+
+            ele_tables = ['ele_trig', 'ele_loose_id_sf', 'ele_tight_id_sf', 'ele_loose_id_eff', 'ele_tight_id_eff', 'ele_reco_sf']
+            mu_tables = ['mu_tight_id_sf', 'mu_loose_id_sf', 'mu_tight_iso_sf', 'mu_loose_iso_sf']
 
             ###
             # For muon ID weights, SFs are given as a function of abs(eta), but in 2016
             ##
 
-            mueta = abs(leading_mu.eta.sum())
-            mu1eta=abs(leading_mu_pair.i0.eta.sum())
-            mu2eta=abs(leading_mu_pair.i1.eta.sum())
+            mueta = memo(lambda: abs(leading_mu.eta.sum()))
+            mu1eta = memo(lambda: abs(leading_dimu.eta0))
+            mu2eta = memo(lambda: abs(leading_dimu.eta1))
             if self._year=='2016':
-                mueta=leading_mu.eta.sum()
-                mu1eta=leading_mu_pair.i0.eta.sum()
-                mu2eta=leading_mu_pair.i1.eta.sum()
+                mueta = memo(lambda: leading_mu.eta.sum())
+                mu1eta = memo(lambda: leading_dimu.eta0)
+                mu2eta = memo(lambda: leading_dimu.eta1)
+
+            e_weights  = memo(lambda: get_lepton_weights(ele_tables, leading_e.eta.sum(), leading_e.pt.sum()))
+            e1_weights = memo(lambda: get_lepton_weights(ele_tables, leading_diele.eta0, leading_diele.pt0))
+            e2_weights = memo(lambda: get_lepton_weights(ele_tables, leading_diele.eta1, leading_diele.pt1))
+            mu_weights  = memo(lambda: get_lepton_weights(mu_tables, mueta(), leading_mu.pt.sum()))
+            mu1_weights = memo(lambda: get_lepton_weights(mu_tables, mu1eta(), leading_dimu.pt0))
+            mu2_weights = memo(lambda: get_lepton_weights(mu_tables, mu2eta(), leading_dimu.pt1))
+
+            ###
+            # Trigger efficiency weight
+            ###
+            
+            ele1_trig_weight = memo(lambda: e1_weights()['ele_trig'])
+            ele2_trig_weight = memo(lambda: e2_weights()['ele_trig'])
+
+            trig = {}
+            trig['wecr'] = memo(lambda: e_weights()['ele_trig'])
+            trig['tecr'] = trig['wecr']
+            trig['zecr'] = memo(lambda: 1 - (1-ele1_trig_weight())*(1-ele2_trig_weight()))
+            trig['gcr'] = memo(lambda: get_pho_trig_weight(leading_pho.pt.sum()))
+
+            def jet_trig(jp):
+                # MET trigger weights depend on the AK4 pass through the MET and the recoil
+                out = dict(trig)
+                out['sr'] = memo(lambda: get_met_trig_weight(jp['met_pt']))
+                out['wmcr'] = memo(lambda: get_met_trig_weight(jp['u_mag']['wmcr']))
+                out['tmcr'] = out['wmcr']
+                out['zmcr'] = memo(lambda: get_met_zmm_trig_weight(jp['u_mag']['zmcr']))
+                return out
 
             ### 
             # Calculating electron and muon ID SF and efficiencies (when provided)
             ###
 
-            mu1Tsf = get_mu_tight_id_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Tsf = get_mu_tight_id_sf(mu2eta,leading_mu_pair.i1.pt.sum())
-            mu1Lsf = get_mu_loose_id_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Lsf = get_mu_loose_id_sf(mu2eta,leading_mu_pair.i1.pt.sum())
+            mu1Tsf = memo(lambda: mu1_weights()['mu_tight_id_sf'])
+            mu2Tsf = memo(lambda: mu2_weights()['mu_tight_id_sf'])
+            mu1Lsf = memo(lambda: mu1_weights()['mu_loose_id_sf'])
+            mu2Lsf = memo(lambda: mu2_weights()['mu_loose_id_sf'])
     
-            e1Tsf  = get_ele_tight_id_sf(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Tsf  = get_ele_tight_id_sf(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
-            e1Lsf  = get_ele_loose_id_sf(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Lsf  = get_ele_loose_id_sf(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            e1Tsf  = memo(lambda: e1_weights()['ele_tight_id_sf'])
+            e2Tsf  = memo(lambda: e2_weights()['ele_tight_id_sf'])
+            e1Lsf  = memo(lambda: e1_weights()['ele_loose_id_sf'])
+            e2Lsf  = memo(lambda: e2_weights()['ele_loose_id_sf'])
 
-            e1Teff= get_ele_tight_id_eff(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Teff= get_ele_tight_id_eff(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
-            e1Leff= get_ele_loose_id_eff(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Leff= get_ele_loose_id_eff(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            e1Teff= memo(lambda: e1_weights()['ele_tight_id_eff'])
+            e2Teff= memo(lambda: e2_weights()['ele_tight_id_eff'])
+            e1Leff= memo(lambda: e1_weights()['ele_loose_id_eff'])
+            e2Leff= memo(lambda: e2_weights()['ele_loose_id_eff'])
 
             ids={}
-            ids['sr'] = np.ones(events.size)
-            ids['wmcr'] = get_mu_tight_id_sf(mueta,leading_mu.pt.sum())
+            ids['sr'] = memo(lambda: np.ones(events.size))
+            ids['wmcr'] = memo(lambda: mu_weights()['mu_tight_id_sf'])
             ids['tmcr'] = ids['wmcr']
-            #ids['zmcr'] = ( (mu1Tsf * mu2Lsf) + (mu1Lsf * mu2Tsf) ) / 2.
-            ids['zmcr'] = mu1Lsf*mu2Lsf
-            ids['wecr'] = get_ele_tight_id_sf(leading_e.eta.sum(),leading_e.pt.sum())
+            #ids['zmcr'] = memo(lambda: ( (mu1Tsf() * mu2Lsf()) + (mu1Lsf() * mu2Tsf()) ) / 2.)
+            ids['zmcr'] = memo(lambda: mu1Lsf()*mu2Lsf())
+            ids['wecr'] = memo(lambda: e_weights()['ele_tight_id_sf'])
             ids['tecr'] = ids['wecr']
-            #ids['zecr'] = ( ( e1Tsf*e1Teff * e2Lsf*e2Leff ) + ( e1Lsf*e1Leff * e2Tsf*e2Teff ) ) / ( (e1Teff*e2Leff) + (e1Leff*e2Teff) )
-            ids['zecr'] = e1Lsf*e2Lsf
-            ids['gcr']  = get_pho_tight_id_sf(leading_pho.eta.sum(),leading_pho.pt.sum())
+            #ids['zecr'] = memo(lambda: ( ( e1Tsf()*e1Teff() * e2Lsf()*e2Leff() ) + ( e1Lsf()*e1Leff() * e2Tsf()*e2Teff() ) ) / ( (e1Teff()*e2Leff()) + (e1Leff()*e2Teff()) ))
+            ids['zecr'] = memo(lambda: e1Lsf()*e2Lsf())
+            ids['gcr']  = memo(lambda: get_pho_tight_id_sf(leading_pho.eta.sum(),leading_pho.pt.sum()))
 
             ###
             # Reconstruction weights for electrons
             ###
             
-            e1sf_reco = get_ele_reco_sf(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2sf_reco = get_ele_reco_sf(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            e1sf_reco = memo(lambda: e1_weights()['ele_reco_sf'])
+            e2sf_reco = memo(lambda: e2_weights()['ele_reco_sf'])
 
             reco = {}
-            reco['sr'] = np.ones(events.size)
-            reco['wmcr'] = np.ones(events.size)
-            reco['tmcr'] = np.ones(events.size)
-            reco['zmcr'] = np.ones(events.size)
-            reco['wecr'] = get_ele_reco_sf(leading_e.eta.sum(),leading_e.pt.sum())
+            reco['sr'] = memo(lambda: np.ones(events.size))
+            reco['wmcr'] = reco['sr']
+            reco['tmcr'] = reco['sr']
+            reco['zmcr'] = reco['sr']
+            reco['wecr'] = memo(lambda: e_weights()['ele_reco_sf'])
             reco['tecr'] = reco['wecr']
-            reco['zecr'] = e1sf_reco * e2sf_reco
-            reco['gcr'] = np.ones(events.size)
+            reco['zecr'] = memo(lambda: e1sf_reco() * e2sf_reco())
+            reco['gcr'] = reco['sr']
 
             ###
             # Isolation weights for muons
             ###
 
-            mu1Tsf_iso = get_mu_tight_iso_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Tsf_iso = get_mu_tight_iso_sf(mu2eta,leading_mu_pair.i1.pt.sum())
-            mu1Lsf_iso = get_mu_loose_iso_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Lsf_iso = get_mu_loose_iso_sf(mu2eta,leading_mu_pair.i1.pt.sum())
+            mu1Tsf_iso = memo(lambda: mu1_weights()['mu_tight_iso_sf'])
+            mu2Tsf_iso = memo(lambda: mu2_weights()['mu_tight_iso_sf'])
+            mu1Lsf_iso = memo(lambda: mu1_weights()['mu_loose_iso_sf'])
+            mu2Lsf_iso = memo(lambda: mu2_weights()['mu_loose_iso_sf'])
 
             isolation = {}
-            isolation['sr']   = np.ones(events.size)
-            isolation['wmcr'] = get_mu_tight_iso_sf(mueta,leading_mu.pt.sum())
+            isolation['sr']   = memo(lambda: np.ones(events.size))
+            isolation['wmcr'] = memo(lambda: mu_weights()['mu_tight_iso_sf'])
             isolation['tmcr'] = isolation['wmcr']
-            #isolation['zmcr'] = ( (mu1Tsf_iso*mu2Lsf_iso) + (mu1Lsf_iso*mu2Tsf_iso) ) / 2.
-            isolation['zmcr'] = mu1Lsf_iso*mu2Lsf_iso
-            isolation['wecr'] = np.ones(events.size)
-            isolation['tecr'] = np.ones(events.size)
-            isolation['zecr'] = np.ones(events.size)
-            isolation['gcr']  = np.ones(events.size)
+            #isolation['zmcr'] = memo(lambda: ( (mu1Tsf_iso()*mu2Lsf_iso()) + (mu1Lsf_iso()*mu2Tsf_iso()) ) / 2.)
+            isolation['zmcr'] = memo(lambda: mu1Lsf_iso()*mu2Lsf_iso())
+            isolation['wecr'] = isolation['sr']
+            isolation['tecr'] = isolation['sr']
+            isolation['zecr'] = isolation['sr']
+            isolation['gcr']  = isolation['sr']
 
             ###
-            # AK4 b-tagging weights
+            # AK4 b-tagging weights, as (nominal, up, down)
             ###
 
-            btag = {}
-            btagUp = {}
-            btagDown = {}
-            btag['sr'],   btagUp['sr'],   btagDown['sr']   = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['wmcr'], btagUp['wmcr'], btagDown['wmcr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['tmcr'], btagUp['tmcr'], btagDown['tmcr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'-1')
-            btag['wecr'], btagUp['wecr'], btagDown['wecr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['tecr'], btagUp['tecr'], btagDown['tecr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'-1')
-            btag['zmcr'], btagUp['zmcr'], btagDown['zmcr'] = np.ones(events.size), np.ones(events.size), np.ones(events.size)#get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['zecr'], btagUp['zecr'], btagDown['zecr'] = np.ones(events.size), np.ones(events.size), np.ones(events.size)#get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['gcr'],  btagUp['gcr'],  btagDown['gcr']  = np.ones(events.size), np.ones(events.size), np.ones(events.size)#get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            
-            for r in selected_regions:
-                weights[r] = processor.Weights(len(events))
-                weights[r].add('genw',events.genWeight)
-                weights[r].add('nlo',nlo)
-                #weights[r].add('adhoc',adhoc)
-                #weights[r].add('nnlo',nnlo)
-                weights[r].add('nnlo_nlo',nnlo_nlo)
-                weights[r].add('pileup',pu)#,puUp,puDown)
-                weights[r].add('trig', trig[r])
-                weights[r].add('ids', ids[r])
-                weights[r].add('reco', reco[r])
-                weights[r].add('isolation', isolation[r])
-                weights[r].add('btag',btag[r], btagUp[r], btagDown[r])
-                
-        leading_fj = fj[fj.pt.argmax()]
-        leading_fj = leading_fj[leading_fj.isgood.astype(np.bool)]
-        leading_fj = leading_fj[leading_fj.isclean.astype(np.bool)]
-        
+            def jet_btag(jp):
+                # 0-tag and >=1-tag weights of the pass come out of one evaluation
+                tags = memo(lambda: get_deepflav_weights['loose'](jp['j_iso_pt'],j.eta[jp['j_iso_mask']],j.hadronFlavour[jp['j_iso_mask']]))
+                btag = {}
+                btag['sr']   = memo(lambda: tags()['0'])
+                btag['wmcr'] = btag['sr']
+                btag['tmcr'] = memo(lambda: tags()['-1'])
+                btag['wecr'] = btag['sr']
+                btag['tecr'] = btag['tmcr']
+                btag['zmcr'] = memo(lambda: (np.ones(events.size), np.ones(events.size), np.ones(events.size)))#btag['sr']
+                btag['zecr'] = btag['zmcr']#btag['sr']
+                btag['gcr']  = btag['zmcr']#btag['sr']
+                return btag
+
+            ###
+            # One set of region weights per AK4 pass, only trigger and b-tagging weights change
+            ###
+
+            for v, jp in jets.items():
+                weights[v] = {}
+                trig_jp, btag_jp = jet_trig(jp), jet_btag(jp)
+                for r in selected_regions:
+                    weights[v][r] = Weights(len(events), dtype=dtype)
+                    weights[v][r].add('genw',events.genWeight)
+                    weights[v][r].add('nlo',nlo)
+                    #weights[v][r].add('adhoc',adhoc)
+                    #weights[v][r].add('nnlo',nnlo)
+                    weights[v][r].add('nnlo_nlo',nnlo_nlo)
+                    weights[v][r].add('pileup',pu,puUp,puDown)
+                    weights[v][r].add('trig', trig_jp[r]())
+                    weights[v][r].add('ids', ids[r]())
+                    weights[v][r].add('reco', reco[r]())
+                    weights[v][r].add('isolation', isolation[r]())
+                    weights[v][r].add('btag', *btag_jp[r]())
+
         ###
         #Importing the MET filters per year from metfilters.py and constructing the filter boolean
         ###
@@ -1011,77 +1083,81 @@ class AnalysisProcessor(processor.ProcessorABC):
         met_filters =  np.ones(events.size, dtype=np.bool)
         for flag in AnalysisProcessor.met_filter_flags[self._year]:
             met_filters = met_filters & events.Flag[flag]
-        selection.add('met_filters',met_filters)
 
         triggers = np.zeros(events.size, dtype=np.bool)
         for path in self._met_triggers[self._year]:
             if path not in events.HLT.columns: continue
             triggers = triggers | events.HLT[path]
-        selection.add('met_triggers', triggers)
+        met_triggers = triggers
 
         triggers = np.zeros(events.size, dtype=np.bool)
         for path in self._singleelectron_triggers[self._year]:
             if path not in events.HLT.columns: continue
             triggers = triggers | events.HLT[path]
-        selection.add('singleelectron_triggers', triggers)
+        singleelectron_triggers = triggers
 
         triggers = np.zeros(events.size, dtype=np.bool)
         for path in self._singlephoton_triggers[self._year]:
             if path not in events.HLT.columns: continue
             triggers = triggers | events.HLT[path]
-        selection.add('singlephoton_triggers', triggers)
-
-        noHEMj = np.ones(events.size, dtype=np.bool)
-        if self._year=='2018': noHEMj = (j_nHEM==0)
-
-        selection.add('iszeroL',
-                      (e_nloose==0)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
-                      &(abs(met.T.delta_phi(j_clean.T)).min()>0.8)
-                      &(met.pt>250)
-                  )
-        selection.add('isoneM', 
-                      (e_nloose==0)&(mu_ntight==1)&(tau_nloose==0)&(pho_nloose==0)
-                      &(abs(um.delta_phi(j_clean.T)).min()>0.8)
-                      &(um.mag>250)
-                  )
-        selection.add('isoneE', 
-                      (e_ntight==1)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
-                      &(met.pt>50)
-                      &(abs(ue.delta_phi(j_clean.T)).min()>0.8)
-                      &(ue.mag>250)
-                  )
-        selection.add('istwoM', 
-                      #(e_nloose==0)&(mu_ntight>=1)&(mu_nloose==2)&(tau_nloose==0)&(pho_nloose==0)
-                      (e_nloose==0)&(mu_nloose==2)&(tau_nloose==0)&(pho_nloose==0)
-                      &(leading_dimu.mass.sum()>60)&(leading_dimu.mass.sum()<120)
-                      &(leading_dimu.pt.sum()>200)
-                      &(abs(umm.delta_phi(j_clean.T)).min()>0.8)
-                      &(umm.mag>250)
-                  )
-        selection.add('istwoE', 
-                      #(e_ntight>=1)&(e_nloose==2)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
-                      (e_nloose==2)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
-                      &(leading_diele.mass.sum()>60)&(leading_diele.mass.sum()<120)
-                      &(leading_diele.pt.sum()>200)
-                      &(abs(uee.delta_phi(j_clean.T)).min()>0.8)
-                      &(uee.mag>250)
-                  )
-        selection.add('isoneA', 
-                      (e_nloose==0)&(mu_nloose==0)&(tau_nloose==0)&(pho_ntight==1)
-                      &(abs(ua.delta_phi(j_clean.T)).min()>0.8)
-                      &(ua.mag>250)
-                  )
-        selection.add('monohs', (leading_fj.ZHbbvsQCD.sum()>0.65))
-        selection.add('monojet', ~(leading_fj.ZHbbvsQCD.sum()>0.65))
-        selection.add('noextrab', (j_ndflvL==0))
-        selection.add('extrab', (j_ndflvL>0))
-        selection.add('mass0', (leading_fj.msd_corr.sum()<30))
-        selection.add('mass1', (leading_fj.msd_corr.sum()>=30)&(leading_fj.msd_corr.sum()<60))
-        selection.add('mass2', (leading_fj.msd_corr.sum()>=60)&(leading_fj.msd_corr.sum()<80))
-        selection.add('mass3', (leading_fj.msd_corr.sum()>=80)&(leading_fj.msd_corr.sum()<120))
-        selection.add('mass4', (leading_fj.msd_corr.sum()>=120))
-        selection.add('fatjet', (fj_nclean>0)&(fj_clean.pt.max()>160))
-        selection.add('noHEMj', noHEMj)
+        singlephoton_triggers = triggers
+
+        ###
+        # Region cuts of one jet pass, the trigger, lepton and photon masks are shared
+        ###
+
+        def region_selection(jp):
+            selection = processor.PackedSelection()
+            selection.add('met_filters',met_filters)
+            selection.add('met_triggers', met_triggers)
+            selection.add('singleelectron_triggers', singleelectron_triggers)
+            selection.add('singlephoton_triggers', singlephoton_triggers)
+
+            noHEMj = np.ones(events.size, dtype=bool)
+            if self._year=='2018': noHEMj = (jp['j_nHEM']==0)
+
+            selection.add('iszeroL',
+                          (e_nloose==0)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
+                          &(jp['u_mindphi']['sr']>0.8)
+                          &(jp['met_pt']>250)
+                      )
+            selection.add('isoneM', 
+                          (e_nloose==0)&(mu_ntight==1)&(tau_nloose==0)&(pho_nloose==0)
+                          &(jp['u_mindphi']['wmcr']>0.8)
+                          &(jp['u_mag']['wmcr']>250)
+                      )
+            selection.add('isoneE', 
+                          (e_ntight==1)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
+                          &(jp['met_pt']>50)
+                          &(jp['u_mindphi']['wecr']>0.8)
+                          &(jp['u_mag']['wecr']>250)
+                      )
+            selection.add('istwoM', 
+                          #(e_nloose==0)&(mu_ntight>=1)&(mu_nloose==2)&(tau_nloose==0)&(pho_nloose==0)
+                          (e_nloose==0)&(mu_nloose==2)&(tau_nloose==0)&(pho_nloose==0)
+                          &(leading_dimu.mass>60)&(leading_dimu.mass<120)
+                          &(leading_dimu.pt>200)
+                          &(jp['u_mindphi']['zmcr']>0.8)
+                          &(jp['u_mag']['zmcr']>250)
+                      )
+            selection.add('istwoE', 
+                          #(e_ntight>=1)&(e_nloose==2)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
+                          (e_nloose==2)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
+                          &(leading_diele.mass>60)&(leading_diele.mass<120)
+                          &(leading_diele.pt>200)
+                          &(jp['u_mindphi']['zecr']>0.8)
+                          &(jp['u_mag']['zecr']>250)
+                      )
+            selection.add('isoneA', 
+                          (e_nloose==0)&(mu_nloose==0)&(tau_nloose==0)&(pho_ntight==1)
+                          &(jp['u_mindphi']['gcr']>0.8)
+                          &(jp['u_mag']['gcr']>250)
+                      )
+            selection.add('noextrab', (jp['j_ndflvL']==0))
+            selection.add('extrab', (jp['j_ndflvL']>0))
+            selection.add('fatjet', (jp['fj_nclean']>0)&(jp['fj_clean_pt'].max()>160))
+            selection.add('noHEMj', noHEMj)
+            return selection
 
         regions = {}
         regions['sr']={'iszeroL','fatjet','noextrab','noHEMj','met_filters','met_triggers'}
@@ -1097,181 +1173,154 @@ class AnalysisProcessor(processor.ProcessorABC):
         for r in selected_regions: 
             temp[r]=regions[r]
         regions=temp
-        temp={}
-        for r in regions:
-            for mass in ['mass0','mass1','mass2','mass3','mass4']:
-                temp[r+'_'+mass]={mass}
-                temp[r+'_'+mass].update(regions[r])
-        regions.update(temp)
-        temp={}
-        for r in regions:
-            for category in ['monojet','monohs']:
-                temp[r+'_'+category]={category}
-                temp[r+'_'+category].update(regions[r])
-        regions.update(temp)
-
-        def fill(dataset, region, systematic, gentype, weight, cut):
-            sname = 'nominal' if systematic is None else systematic
-            variables = {}
-            variables['met']       = met.pt
-            variables['j1pt']      = leading_j.pt
-            variables['j1eta']     = leading_j.eta
-            variables['j1phi']     = leading_j.phi
-            variables['fjmass']    = leading_fj.msd_corr
-            variables['fj1pt']     = leading_fj.pt
-            variables['fj1eta']    = leading_fj.eta
-            variables['fj1phi']    = leading_fj.phi
-            variables['e1pt']      = leading_e.pt
-            variables['e1phi']     = leading_e.phi
-            variables['e1eta']     = leading_e.eta
-            variables['dielemass'] = leading_diele.mass
-            variables['dielept']   = leading_diele.pt
-            variables['mu1pt']     = leading_mu.pt
-            variables['mu1phi']    = leading_mu.phi
-            variables['mu1eta']    = leading_mu.eta
-            variables['dimumass']  = leading_dimu.mass
-            variables['dimupt']    = leading_dimu.pt
-            variables['njets']     = j_nclean
-            variables['ndcsvL']    = j_ndcsvL
-            variables['ndflvL']    = j_ndflvL
-            variables['nfjtot']    = fj_ntot
-            variables['nfjgood']   = fj_ngood
-            variables['nfjclean']  = fj_nclean
-            variables['ZHbbvsQCD'] = leading_fj.ZHbbvsQCD
-            flat_variables = {k: v[cut].flatten() for k, v in variables.items()}
-            flat_weights = {k: (~np.isnan(v[cut])*weight[cut]).flatten() for k, v in variables.items()}
-            for histname, h in hout.items():
-                if not isinstance(h, hist.Hist):
-                    continue
-                elif histname == 'sumw':
-                    continue
-                elif histname == 'recoil':
-                    h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, recoil=u[region.split('_')[0]].mag, weight=weight*cut)
-                elif histname == 'CaloMinusPfOverRecoil':
-                    h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, CaloMinusPfOverRecoil= abs(calomet.pt - met.pt) / u[region.split('_')[0]].mag, weight=weight*cut)
-                elif histname == 'mindphi':
-                    h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, mindphi=abs(u[region.split('_')[0]].delta_phi(j_clean.T)).min(), weight=weight*cut)
-                else:
-                    flat_variable = {histname: flat_variables[histname]}
-                    h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, **flat_variable, weight=flat_weights[histname])
-
-        def get_weight(region,systematic=None):
-            region=region.split('_')[0]
-            if systematic is not None: return weights[region].weight(modifier=systematic)
-            return weights[region].weight()
+        plans = {v: SelectionPlan(region_selection(jp), regions) for v, jp in jets.items()}
+
+        ###
+        # Mass bins and monojet/monohs categories are exclusive partitions of each base region:
+        # every event goes to the base region, one mass sub-region, one category sub-region
+        # and one mass+category sub-region, encoded as indices into the sub-region labels.
+        # The leading AK15 and its mass follow the jet pass
+        ###
+
+        def leading_fatjet(jp):
+            fj_leading, fj_leading_mask = jp['leading_fj']
+            return fj[fj_leading][fj_leading_mask]
+
+        masses = ['mass0','mass1','mass2','mass3','mass4']
+        categories = ['monojet','monohs']
+        subregion = {}
+        for v, jp in jets.items():
+            imass = np.searchsorted([30., 60., 80., 120.], jp['leading_fj_msd_corr'].sum(), side='right')
+            icategory = (leading_fatjet(jp).ZHbbvsQCD.sum()>0.65).astype(int)
+            subregion[v] = np.stack([
+                np.zeros(events.size, dtype=int),
+                1 + imass,
+                1 + len(masses) + icategory,
+                1 + len(masses) + len(categories) + imass*len(categories) + icategory
+            ], axis=1)
+
+        def subregions(r):
+            labels = [r]
+            labels += [r+'_'+mass for mass in masses]
+            labels += [r+'_'+category for category in categories]
+            labels += [r+'_'+mass+'_'+category for mass in masses for category in categories]
+            return labels
+
+        ###
+        # Binning all the variables once per chunk, jet-dependent ones once per jet pass and
+        # recoil-dependent ones once per base region and jet pass
+        ###
+
+        variables = {}
+        variables['e1pt']      = leading_e.pt
+        variables['e1phi']     = leading_e.phi
+        variables['e1eta']     = leading_e.eta
+        variables['dielemass'] = np.where(leading_diele.idx0>=0, leading_diele.mass, np.nan)
+        variables['dielept']   = np.where(leading_diele.idx0>=0, leading_diele.pt, np.nan)
+        variables['mu1pt']     = leading_mu.pt
+        variables['mu1phi']    = leading_mu.phi
+        variables['mu1eta']    = leading_mu.eta
+        variables['dimumass']  = np.where(leading_dimu.idx0>=0, leading_dimu.mass, np.nan)
+        variables['dimupt']    = np.where(leading_dimu.idx0>=0, leading_dimu.pt, np.nan)
+        variables['nfjtot']    = fj_ntot
+
+        filler = HistFiller(hout, events.size, self._common['systematic_histograms'])
+        filler.bin('common', variables)
+        for v, jp in jets.items():
+            leading_fj = leading_fatjet(jp)
+            jet_variables = {}
+            jet_variables['fjmass']    = jp['leading_fj_msd_corr']
+            jet_variables['fj1pt']     = jp['leading_fj_pt']
+            jet_variables['fj1eta']    = leading_fj.eta
+            jet_variables['fj1phi']    = leading_fj.phi
+            jet_variables['nfjgood']   = jp['fj_ngood']
+            jet_variables['nfjclean']  = jp['fj_nclean']
+            jet_variables['ZHbbvsQCD'] = leading_fj.ZHbbvsQCD
+            jet_variables['met']    = jp['met_pt']
+            jet_variables['j1pt']   = jp['leading_j_pt']
+            jet_variables['j1eta']  = jp['leading_j_eta']
+            jet_variables['j1phi']  = jp['leading_j_phi']
+            jet_variables['njets']  = jp['j_nclean']
+            jet_variables['ndcsvL'] = jp['j_ndcsvL']
+            jet_variables['ndflvL'] = jp['j_ndflvL']
+            filler.bin(('jets', v), jet_variables, extends='common')
+
+        def fill(dataset, region, systematics, gentype, weight, cut, variation=None):
+            # A JES/JER variation is filled with its nominal weight under its own name
+            snames = [variation] if variation is not None else ['nominal' if systematic is None else systematic for systematic in systematics]
+            group = (region, variation)
+            if group not in filler:
+                ###
+                # Recoil-dependent variables are binned only for the events passing the region cut
+                ###
+                jp = jets[variation]
+                recoil = {}
+                recoil['recoil']                = jp['u_mag'][region][cut]
+                recoil['CaloMinusPfOverRecoil'] = jp['calominuspf'][cut] / recoil['recoil']
+                recoil['mindphi']               = jp['u_mindphi'][region][cut]
+                filler.bin(group, recoil, extends=('jets', variation), mask=cut)
+            filler.fill(group, weight, cut, dataset=dataset, region=(subregions(region), subregion[variation]), systematic=snames, gentype=gentype)
+
+        def get_weight(region,systematics=[None],variation=None):
+            return weight_matrix(weights[variation][region], systematics)
 
         systematics = [
             None,
             'btagUp',
             'btagDown',
+            'pileupUp',
+            'pileupDown',
         ]
 
         if isData:
             hout['sumw'].fill(dataset=dataset, sumw=1, weight=1)
             for r in regions:
-                cut = selection.all(*regions[r])
-                fill(dataset, r, None, 'data', np.ones(events.size), cut)
+                cut = plans[None].all(r)
+                fill(dataset, r, [None], 'data', np.ones(events.size, dtype=dtype), cut)
         else:
-            wgentype = { 
-                'hsbb' : (
-                    leading_fj.isHsbb
-                ).sum(),
-                'hbb' : (
-                    leading_fj.isHbb
-                ).sum(),
-                'zbb' : (
-                    ~leading_fj.isHbb &
-                    leading_fj.isZbb
-                ).sum(),
-                'tbqq' : (
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    leading_fj.isTbqq 
-                ).sum(),
-                'tqq' : (
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    ~leading_fj.isTbqq &
-                    leading_fj.isTqq
-                ).sum(),
-                'vqq' : (
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    ~leading_fj.isTbqq &
-                    ~leading_fj.isTqq &
-                    (leading_fj.isWqq | leading_fj.isZqq)
-                ).sum(),
-                'bb' : (
-                    ~leading_fj.isHsbb &
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    ~leading_fj.isTbqq &
-                    ~leading_fj.isTqq &
-                    ~(leading_fj.isWqq |leading_fj.isZqq) &
-                    leading_fj.isbb
-                ).sum(),
-                'tbq' : (
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    ~leading_fj.isTbqq &
-                    ~leading_fj.isTqq &
-                    ~(leading_fj.isWqq |leading_fj.isZqq) &
-                    ~leading_fj.isbb &
-                    leading_fj.isTbq 
-                ).sum(),
-                'b' : (
-                    ~leading_fj.isHsbb &
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    ~leading_fj.isTbqq &
-                    ~leading_fj.isTqq &
-                    ~(leading_fj.isWqq |leading_fj.isZqq) &
-                    ~leading_fj.isbb &
-                    ~leading_fj.isTbq &
-                    leading_fj.isb
-                ).sum(),
-                'other' : (
-                    ~leading_fj.isHsbb &
-                    ~leading_fj.isHbb &
-                    ~leading_fj.isZbb &
-                    ~leading_fj.isTbqq &
-                    ~leading_fj.isTqq &
-                    ~(leading_fj.isWqq |leading_fj.isZqq) &
-                    ~leading_fj.isbb &
-                    ~leading_fj.isTbq &
-                    ~leading_fj.isb
-                ).sum(),
-            }
-            wgentype['garbage'] = (
-                (~(wgentype['tbqq'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['tbq'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['tqq'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['hbb'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['hsbb'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['zbb'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['vqq'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['bb'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['b'].astype(np.bool))).astype(np.int) &
-                (~(wgentype['other'].astype(np.bool))).astype(np.int)
-            )
+            ###
+            # Each event gets the first gen type whose fat-jet label is set, following the
+            # label priority order, 'other' if none is and 'garbage' without a leading fat jet.
+            # The leading fat jet, and so the gen type, follows the jet pass
+            ###
+
+            gentypes = ['hsbb', 'hbb', 'zbb', 'tbqq', 'tqq', 'vqq', 'bb', 'tbq', 'b', 'other', 'garbage']
+            gentype = {}
+            for v, jp in jets.items():
+                leading_fj = leading_fatjet(jp)
+                gentype[v] = (gentypes, np.argmax(np.stack([
+                    leading_fj.isHsbb.any(),
+                    leading_fj.isHbb.any(),
+                    leading_fj.isZbb.any(),
+                    leading_fj.isTbqq.any(),
+                    leading_fj.isTqq.any(),
+                    (leading_fj.isWqq | leading_fj.isZqq).any(),
+                    leading_fj.isbb.any(),
+                    leading_fj.isTbq.any(),
+                    leading_fj.isb.any(),
+                    leading_fj.counts>0,
+                    np.ones(events.size, dtype=bool)
+                ]), axis=0))
             if 'WJets' in dataset or 'ZJets' in dataset or 'DY' in dataset or 'GJets' in dataset or 'QCD' in dataset:
-                whf = ((gen[gen.isb].counts>0)|(gen[gen.isc].counts>0)).astype(np.int)
-                wlf = (~(whf.astype(np.bool))).astype(np.int)
-                hout['sumw'].fill(dataset='HF--'+dataset, sumw=1, weight=events.genWeight.sum())
-                hout['sumw'].fill(dataset='LF--'+dataset, sumw=1, weight=events.genWeight.sum())
+                ###
+                # Heavy and light flavor events are routed to their dataset label in the same pass
+                ###
+                flavors = ['HF--'+dataset, 'LF--'+dataset]
+                iflavor = (~((gen[gen.isb].counts>0)|(gen[gen.isc].counts>0))).astype(int)
+                hout['sumw'].fill(dataset='HF--'+dataset, sumw=1, weight=sumw)
+                hout['sumw'].fill(dataset='LF--'+dataset, sumw=1, weight=sumw)
                 for r in regions:
-                    cut = selection.all(*regions[r])
-                    for systematic in systematics:
-                        for gentype in wgentype.keys():
-                            fill('HF--'+dataset, r, systematic, gentype, get_weight(r,systematic=systematic)*whf*wgentype[gentype], cut)
-                            fill('LF--'+dataset, r, systematic, gentype, get_weight(r,systematic=systematic)*wlf*wgentype[gentype], cut)
+                    cut = plans[None].all(r)
+                    fill((flavors, iflavor), r, systematics, gentype[None], get_weight(r,systematics=systematics), cut)
+                    for v in variations:
+                        fill((flavors, iflavor), r, [None], gentype[v], get_weight(r,variation=v), plans[v].all(r), variation=v)
             else:
-                hout['sumw'].fill(dataset=dataset, sumw=1, weight=events.genWeight.sum())
+                hout['sumw'].fill(dataset=dataset, sumw=1, weight=sumw)
                 for r in regions:
-                    cut = selection.all(*regions[r])
-                    for systematic in systematics:
-                        for gentype in wgentype.keys():
-                            fill(dataset, r, systematic, gentype, get_weight(r,systematic=systematic)*wgentype[gentype], cut)
+                    cut = plans[None].all(r)
+                    fill(dataset, r, systematics, gentype[None], get_weight(r,systematics=systematics), cut)
+                    for v in variations:
+                        fill(dataset, r, [None], gentype[v], get_weight(r,variation=v), plans[v].all(r), variation=v)
 
         return hout
 
@@ -1294,6 +1343,8 @@ class AnalysisProcessor(processor.ProcessorABC):
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option('-y', '--year', help='year', dest='year')
+    parser.add_option('-f', '--float32', action='store_true', help='store weights, jet corrections and derived columns in float32', dest='float32', default=False)
+    parser.add_option('-s', '--staged', action='store_true', help='preselect events before building objects', dest='staged', default=False)
     (options, args) = parser.parse_args()
 
 
@@ -1309,6 +1360,8 @@ if __name__ == '__main__':
                                          xsec=xsec,
                                          corrections=corrections,
                                          ids=ids,
-                                         common=common)
+                                         common=common,
+                                         dtype='float32' if options.float32 else 'float64',
+                                         staged=options.staged)
     
     save(processor_instance, 'data/darkhiggs'+options.year+'.processor')
@@ -0,0 +1,116 @@
+import os
+import pickle
+import cloudpickle
+import importlib.util
+import numpy as np
+import awkward
+import pytest
+from coffea import hist, processor
+
+@pytest.fixture(scope='module')
+def common(tmp_path_factory):
+    # util/common.py saves data/common.coffea when loaded, keep it out of the tree
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('common'))
+    os.mkdir('data')
+    try:
+        spec = importlib.util.spec_from_file_location('common', os.path.join(os.path.dirname(__file__), '..', 'util', 'common.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module.common
+
+def axes():
+    return [
+        hist.Cat('dataset', 'Dataset'),
+        hist.Cat('region', 'Region'),
+        hist.Cat('systematic', 'Systematic'),
+        hist.Cat('gentype', 'Gen Type'),
+        hist.Bin('met', 'MET', 10, 0, 100)
+    ]
+
+def fill(common, h, weight, cut, systematic):
+    values = np.random.RandomState(1).uniform(0, 120, cut.size)
+    filler = common['HistFiller']({'met': h}, cut.size)
+    filler.bin('common', {'met': values})
+    filler.fill('common', weight, cut, dataset='data', region=(['sr', 'sr_1'], np.tile([0, 1], (cut.size, 1))), systematic=systematic, gentype=(['a', 'b'], np.arange(cut.size) % 2))
+    return values
+
+@pytest.mark.parametrize('weight, systematic', [
+    (np.ones(20), 'nominal'),
+    (np.ones((20, 3)), ['nominal', 'btagUp', 'btagDown'])
+])
+def test_fill_empty_cut(common, weight, systematic):
+    h = common['DenseHist']('Events', *axes())
+    fill(common, h, weight, np.zeros(20, dtype=bool), systematic)
+    systematics = systematic if isinstance(systematic, list) else [systematic]
+    keys = {(d, r, s, g) for d in ['data'] for r in ['sr', 'sr_1'] for s in systematics for g in ['a', 'b']}
+    values = h.values()
+    assert set(values) == keys
+    assert all(not v.any() for v in values.values())
+
+def test_fill_matches_hist(common):
+    cut = np.arange(20) % 3 > 0
+    weight = np.random.RandomState(2).uniform(0, 2, 20)
+    h = common['DenseHist']('Events', *axes())
+    values = fill(common, h, weight, cut, 'nominal')
+    ref = hist.Hist('Events', *axes())
+    for region in ['sr', 'sr_1']:
+        for igentype, gentype in enumerate(['a', 'b']):
+            ref.fill(dataset='data', region=region, systematic='nominal', gentype=gentype, met=values, weight=weight*cut*(np.arange(20) % 2 == igentype))
+    expected = ref.values(sumw2=True)
+    assert set(h.values(sumw2=True)) == set(expected)
+    for key, (sumw, sumw2) in h.values(sumw2=True).items():
+        assert np.allclose(sumw, expected[key][0]) and np.allclose(sumw2, expected[key][1])
+
+def test_fill_extends(common):
+    cut = np.arange(20) % 4 > 0
+    values = np.random.RandomState(3).uniform(0, 120, 20)
+    hout = {'met': common['DenseHist']('Events', *axes()), 'recoil': common['DenseHist']('Events', *axes()[:-1], hist.Bin('recoil', 'Recoil', 10, 0, 100))}
+    filler = common['HistFiller'](hout, 20)
+    filler.bin('common', {'met': values})
+    filler.bin('recoil', {'recoil': values[cut]}, extends='common', mask=cut)
+    filler.fill('recoil', np.ones(20), cut, dataset='data', region='sr', systematic='nominal', gentype='a')
+    expected = np.histogram(values[cut], bins=10, range=(0, 100))[0]
+    for histname, h in hout.items():
+        assert np.allclose(h.values()[('data', 'sr', 'nominal', 'a')], expected)
+
+def test_dense_output_pickle(common):
+    out = common['DenseOutput']({'met': common['DenseHist']('Events', *axes())})
+    cut = np.ones(20, dtype=bool)
+    fill(common, out['met'], np.ones(20), cut, 'nominal')
+    for dumps, loads in [(pickle.dumps, pickle.loads), (cloudpickle.dumps, cloudpickle.loads)]:
+        copy = loads(dumps(out))
+        assert type(copy) is common['DenseOutput']
+        assert type(copy['met']) is common['DenseHist']
+        copy.add(out)
+        assert np.allclose(copy['met'].values()[('data', 'sr', 'nominal', 'a')], 2*out['met'].values()[('data', 'sr', 'nominal', 'a')])
+
+def test_selection_plan(common):
+    rng = np.random.RandomState(4)
+    selection = processor.PackedSelection()
+    for name in ['met_filters', 'fatjet', 'noHEMj', 'iszeroL', 'isoneM', 'met_triggers']:
+        selection.add(name, rng.uniform(size=100) > 0.3)
+    regions = {
+        'sr': {'met_filters', 'fatjet', 'noHEMj', 'iszeroL', 'met_triggers'},
+        'wmcr': {'met_filters', 'fatjet', 'noHEMj', 'isoneM', 'met_triggers'},
+        'tmcr': {'met_filters', 'fatjet', 'noHEMj', 'isoneM', 'met_triggers'},
+        'gcr': {'fatjet', 'noHEMj'}
+    }
+    plan = common['SelectionPlan'](selection, regions)
+    for region, cuts in regions.items():
+        assert np.array_equal(plan.all(region), selection.all(*cuts))
+    assert plan.all('wmcr') is plan.all('tmcr')
+
+def test_fill_restricted(common):
+    values = np.random.RandomState(5).uniform(0, 120, 20)
+    hout = {'met': common['DenseHist']('Events', *axes()), 'recoil': common['DenseHist']('Events', *axes()[:-1], hist.Bin('recoil', 'Recoil', 10, 0, 100))}
+    filler = common['HistFiller'](hout, 20, common['systematic_histograms'])
+    filler.bin('common', {'met': values, 'recoil': values})
+    filler.fill('common', np.ones((20, 3)), np.ones(20, dtype=bool), dataset='data', region='sr', systematic=['nominal', 'pileupUp', 'pileupDown'], gentype='a')
+    assert set(hout['met'].values()) == {('data', 'sr', 'nominal', 'a')}
+    assert set(hout['recoil'].values()) == {('data', 'sr', s, 'a') for s in ['nominal', 'pileupUp', 'pileupDown']}
+    expected = np.histogram(values, bins=10, range=(0, 100))[0]
+    assert np.allclose(hout['met'].values()[('data', 'sr', 'nominal', 'a')], expected)
+    assert np.allclose(hout['recoil'].values()[('data', 'sr', 'pileupUp', 'a')], expected)
@@ -1,11 +1,274 @@
 from coffea.util import save
+from coffea import hist, processor
+from collections.abc import MutableMapping
 import awkward
 import uproot, uproot_methods
 import numpy as np
+import numbers
+import copy
+import cloudpickle
+import numba
+
+###
+# Delta-R matching: walks the two collections event by event and flags the objects of a
+# having at least one object of b within its dR threshold, without building their cross
+# product. Cleaning against several collections merges them first into one veto
+# collection carrying per-object thresholds, so that each target is cleaned in one pass
+###
+
+@numba.njit
+def match_kernel(a_starts, a_stops, a_eta, a_phi, b_starts, b_stops, b_eta, b_phi, b_val):
+    out = np.zeros(np.sum(a_stops - a_starts), dtype=np.bool_)
+    k = 0
+    for i in range(a_starts.size):
+        for ia in range(a_starts[i], a_stops[i]):
+            for ib in range(b_starts[i], b_stops[i]):
+                deta = a_eta[ia] - b_eta[ib]
+                dphi = (a_phi[ia] - b_phi[ib] + np.pi) % (2*np.pi) - np.pi
+                if np.sqrt(deta*deta + dphi*dphi) < b_val[ib]:
+                    out[k] = True
+                    break
+            k += 1
+    return out
 
 def match(a, b, val):
-    combinations = a.cross(b, nested=True)
-    return (combinations.i0.delta_r(combinations.i1)<val).any()
+    b_eta = np.asarray(b.eta.content)
+    return awkward.JaggedArray.fromcounts(a.counts, match_kernel(
+        a.starts, a.stops, np.asarray(a.eta.content), np.asarray(a.phi.content),
+        b.starts, b.stops, b_eta, np.asarray(b.phi.content), np.full(b_eta.size, val)
+    ))
+
+def vetoes(collections):
+    # Merges (collection, dR) pairs into one per-event veto collection
+    eta = awkward.JaggedArray.concatenate([c.eta for c, val in collections], axis=1)
+    phi = awkward.JaggedArray.concatenate([c.phi for c, val in collections], axis=1)
+    val = awkward.JaggedArray.concatenate([c.eta.ones_like()*val for c, val in collections], axis=1)
+    return eta, phi, val
+
+def clean(a, veto):
+    # Objects of a with no veto object within the dR threshold of the latter
+    eta, phi, val = veto
+    offsets = awkward.JaggedArray.counts2offsets(eta.counts)
+    return ~awkward.JaggedArray.fromcounts(a.counts, match_kernel(
+        a.starts, a.stops, np.asarray(a.eta.content), np.asarray(a.phi.content),
+        offsets[:-1], offsets[1:], np.asarray(eta.flatten()), np.asarray(phi.flatten()), np.asarray(val.flatten(), dtype=np.float64)
+    ))
+
+###
+# Leading dilepton: picks in one pass the pair with the highest pt among the distinct
+# pairs of a collection, returning per-event dense columns (pair pt, phi, mass and legs
+# pt, eta, phi) set to zero, and indices set to -1, for events without a pair. The leg
+# indices are named idx0/idx1: i0/i1 are the positional column accessors of a Table
+###
+
+@numba.njit
+def leading_pair_kernel(starts, stops, pt, eta, phi, mass):
+    n = starts.size
+    i0, i1 = np.full(n, -1, dtype=np.int64), np.full(n, -1, dtype=np.int64)
+    out = np.zeros((9, n))
+    for i in range(n):
+        best = -1.
+        for a in range(starts[i], stops[i]):
+            for b in range(a+1, stops[i]):
+                px = pt[a]*np.cos(phi[a]) + pt[b]*np.cos(phi[b])
+                py = pt[a]*np.sin(phi[a]) + pt[b]*np.sin(phi[b])
+                ptll = np.sqrt(px*px + py*py)
+                if ptll <= best: continue
+                best = ptll
+                pz = pt[a]*np.sinh(eta[a]) + pt[b]*np.sinh(eta[b])
+                e = np.sqrt((pt[a]*np.cosh(eta[a]))**2 + mass[a]**2) + np.sqrt((pt[b]*np.cosh(eta[b]))**2 + mass[b]**2)
+                i0[i], i1[i] = a - starts[i], b - starts[i]
+                out[0, i], out[1, i], out[2, i] = ptll, np.arctan2(py, px), np.sqrt(max(e*e - px*px - py*py - pz*pz, 0.))
+                out[3, i], out[4, i], out[5, i] = pt[a], eta[a], phi[a]
+                out[6, i], out[7, i], out[8, i] = pt[b], eta[b], phi[b]
+    return i0, i1, out
+
+def leading_pair(leptons, dtype=np.float64):
+    i0, i1, out = leading_pair_kernel(
+        leptons.starts, leptons.stops, np.asarray(leptons.pt.content), np.asarray(leptons.eta.content),
+        np.asarray(leptons.phi.content), np.asarray(leptons.mass.content)
+    )
+    columns = dict(zip(['pt', 'phi', 'mass', 'pt0', 'eta0', 'phi0', 'pt1', 'eta1', 'phi1'], out.astype(dtype)))
+    return awkward.Table(idx0=i0, idx1=i1, **columns)
+
+###
+# Minimum delta-phi between several per-event reference directions (recoil hypotheses)
+# and the objects of a collection, all the references are compared to each object in a
+# single pass over the collection content. Events without objects get +inf, as .min()
+###
+
+@numba.njit
+def min_dphi_kernel(starts, stops, phi, ref_phi):
+    out = np.full(ref_phi.shape, np.inf)
+    for i in range(starts.size):
+        for j in range(starts[i], stops[i]):
+            for k in range(ref_phi.shape[0]):
+                dphi = abs((ref_phi[k, i] - phi[j] + np.pi) % (2*np.pi) - np.pi)
+                if dphi < out[k, i]:
+                    out[k, i] = dphi
+    return out
+
+def min_dphi(refs, phi, dtype=np.float64):
+    # refs maps names to per-event phi arrays, phi is the jagged phi of the objects,
+    # returns the same mapping to min delta-phi
+    out = min_dphi_kernel(
+        phi.starts, phi.stops, np.asarray(phi.content),
+        np.stack([np.asarray(ref_phi, dtype=np.float64) for ref_phi in refs.values()])
+    )
+    return dict(zip(refs.keys(), out.astype(dtype)))
+
+###
+# Object flags: the boolean properties of the objects of a collection are packed in one
+# uint16 column, subsets are bit-mask predicates over it and multiplicities are counted
+# from the predicates, without materializing a filtered copy of the collection per step
+###
+
+OBJECT_FLAGS = ['isloose', 'istight', 'isclean', 'isgood', 'isiso', 'isdcsvL', 'isdflvL', 'isHEM']
+
+def pack_flags(**masks):
+    flags = None
+    for name, mask in masks.items():
+        bit = mask.astype(np.uint16) << np.uint16(OBJECT_FLAGS.index(name))
+        flags = bit if flags is None else flags | bit
+    return flags
+
+def has_flags(flags, *names):
+    bits = np.uint16(sum(1 << OBJECT_FLAGS.index(name) for name in names))
+    return (flags & bits) == bits
+
+###
+# GenPart ancestry table: distinct parent (first ancestor with a different pdgId) index
+# and pdgId, distinct grandparent pdgId and decoded statusFlags bits, computed once per
+# chunk with a compiled walk over the mother indices so gen selections are array lookups
+###
+
+GENFLAGS = [
+    'isPrompt',
+    'isDecayedLeptonHadron',
+    'isTauDecayProduct',
+    'isPromptTauDecayProduct',
+    'isDirectTauDecayProduct',
+    'isDirectPromptTauDecayProduct',
+    'isDirectHadronDecayProduct',
+    'isHardProcess',
+    'fromHardProcess',
+    'isHardProcessTauDecayProduct',
+    'isDirectHardProcessTauDecayProduct',
+    'fromHardProcessBeforeFSR',
+    'isFirstCopy',
+    'isLastCopy',
+    'isLastCopyBeforeFSR'
+]
+
+@numba.njit
+def distinct_parent_kernel(offsets, pdg, mother):
+    out = np.full(pdg.size, -1, dtype=np.int64)
+    for i in range(offsets.size-1):
+        start = offsets[i]
+        for ig in range(start, offsets[i+1]):
+            parent = mother[ig]
+            while parent >= 0 and pdg[start+parent] == pdg[ig]:
+                parent = mother[start+parent]
+            out[ig] = parent
+    return out
+
+def gen_mother(gen):
+    # Local mother index (genPartIdxMother, dropped by NanoEvents once the collection is
+    # built) recovered from the parent cross-reference, which holds global indices
+    jagged = gen.array if isinstance(gen, awkward.VirtualArray) else gen
+    content = jagged.content.array if isinstance(jagged.content, awkward.VirtualArray) else jagged.content
+    parent = content.parent
+    if isinstance(parent, awkward.VirtualArray): parent = parent.array
+    mother = awkward.JaggedArray(jagged.starts, jagged.stops, parent.mask)
+    return np.where(mother.flatten() >= 0, (mother - jagged.starts).flatten(), -1)
+
+def gen_ancestry(gen, flags=['fromHardProcess', 'isFirstCopy', 'isLastCopy']):
+    offsets = awkward.JaggedArray.counts2offsets(gen.counts)
+    pdg = np.asarray(gen.pdgId.flatten())
+    parent = distinct_parent_kernel(offsets, pdg, gen_mother(gen))
+    first = np.repeat(offsets[:-1], gen.counts)
+    hasparent = parent >= 0
+    grandparent = np.where(hasparent, parent[first + np.where(hasparent, parent, 0)], -1)
+    table = {}
+    table['distinctParentIdx'] = parent
+    table['distinctParentPdgId'] = np.where(hasparent, pdg[first + np.where(hasparent, parent, 0)], 0)
+    table['distinctGrandparentPdgId'] = np.where(grandparent >= 0, pdg[first + np.where(grandparent >= 0, grandparent, 0)], 0)
+    statusFlags = np.asarray(gen.statusFlags.flatten())
+    for flag in flags:
+        table[flag] = ((statusFlags >> GENFLAGS.index(flag)) & 1).astype(bool)
+    return {column: awkward.JaggedArray.fromcounts(gen.counts, values) for column, values in table.items()}
+
+###
+# Fat-jet gen-truth labelling: the hard-process partons of each event are walked once,
+# counting for every fat jet how many partons of each kind lie within dR, and all the
+# labels are derived from those counts. Partons of a kind are required to be all within
+# dR of the fat jet (or at least one for isTbq W partons), with at least one in the event
+###
+
+@numba.njit
+def gen_match_kernel(fj_offsets, fj_eta, fj_phi, gen_offsets, gen_eta, gen_phi, gen_kind, nkinds, val):
+    matched = np.zeros((fj_eta.size, nkinds), dtype=np.int64)
+    total = np.zeros((fj_offsets.size-1, nkinds), dtype=np.int64)
+    for i in range(fj_offsets.size-1):
+        for ig in range(gen_offsets[i], gen_offsets[i+1]):
+            if gen_kind[ig] == 0: continue
+            for k in range(nkinds):
+                if (gen_kind[ig] >> k) & 1: total[i, k] += 1
+            for ij in range(fj_offsets[i], fj_offsets[i+1]):
+                deta = fj_eta[ij] - gen_eta[ig]
+                dphi = (fj_phi[ij] - gen_phi[ig] + np.pi) % (2*np.pi) - np.pi
+                if np.sqrt(deta*deta + dphi*dphi) < val:
+                    for k in range(nkinds):
+                        if (gen_kind[ig] >> k) & 1: matched[ij, k] += 1
+    return matched, total
+
+def fatjet_gen_labels(fj, gen, val=1.5):
+    # gen carries the gen_ancestry columns
+    pdg = np.asarray(gen.pdgId.flatten())
+    parent = np.asarray(gen.distinctParentPdgId.flatten())
+    grandparent = np.asarray(gen.distinctGrandparentPdgId.flatten())
+    hard = np.asarray((gen.fromHardProcess & gen.isFirstCopy).flatten())
+    last = np.asarray((gen.fromHardProcess & gen.isLastCopy).flatten())
+    q = hard & (abs(pdg) < 5)
+    b = hard & (abs(pdg) == 5)
+    qFromW = q & (abs(parent) == 24)
+    kinds = [
+        qFromW,
+        qFromW & (grandparent == 6),
+        qFromW & (grandparent == -6),
+        b & (parent == 6),
+        b & (parent == -6),
+        b & (abs(parent) == 23),
+        q & (abs(parent) == 23),
+        b & (abs(parent) == 25),
+        b & (abs(parent) == 54),
+        last & (abs(pdg) == 5),
+    ]
+    kind = np.zeros(pdg.size, dtype=np.int64)
+    for k, selected in enumerate(kinds):
+        kind |= selected.astype(np.int64) << k
+    fj_offsets = awkward.JaggedArray.counts2offsets(fj.counts)
+    gen_offsets = awkward.JaggedArray.counts2offsets(gen.counts)
+    matched, total = gen_match_kernel(
+        fj_offsets, np.asarray(fj.eta.flatten()), np.asarray(fj.phi.flatten()),
+        gen_offsets, np.asarray(gen.eta.flatten()), np.asarray(gen.phi.flatten()),
+        kind, len(kinds), val
+    )
+    total = np.repeat(total, fj.counts, axis=0)
+    def all_within(k): return (matched[:, k] == total[:, k]) & (total[:, k] > 0)
+    def any_within(k): return (matched[:, k] > 0) & (total[:, k] > 0)
+    labels = {}
+    labels['isTbqq'] = (all_within(1) & all_within(3)) | (all_within(2) & all_within(4))
+    labels['isTqq']  = all_within(1) | all_within(2)
+    labels['isTbq']  = (any_within(1) & all_within(3)) | (any_within(2) & all_within(4))
+    labels['isWqq']  = all_within(0)
+    labels['isZbb']  = all_within(5)
+    labels['isZqq']  = all_within(6)
+    labels['isHbb']  = all_within(7)
+    labels['isHsbb'] = all_within(8)
+    labels['isb']    = (matched[:, 9] == 1) & (total[:, 9] > 0)
+    labels['isbb']   = (matched[:, 9] == 2) & (total[:, 9] > 0)
+    return {label: awkward.JaggedArray.fromcounts(fj.counts, mask) for label, mask in labels.items()}
 
 deepflavWPs = {
     '2016': {
@@ -46,8 +309,365 @@ btagWPs = {
     'deepflav': deepflavWPs,
     'deepcsv' : deepcsvWPs
 }
-    
+
+###
+# Dense accumulator backend: hist.Hist keeping the sums of weights of all the
+# category combinations in one contiguous array, indexed by the position of each
+# label along its sparse axis. hist.Hist methods see the usual {sparse key: array}
+# dicts, made of views of that array, so integrate/group/scale/values keep working,
+# while merging two DenseHist is a single array addition
+###
+
+class DenseSums(MutableMapping):
+
+    def __init__(self, h, array):
+        self._h = h
+        self._array = array
+
+    def __getitem__(self, key):
+        slot = self._h._slot(key)
+        if slot is None or not self._h._filled[slot]: raise KeyError(key)
+        return getattr(self._h, self._array)[slot]
+
+    def __setitem__(self, key, value):
+        slot = self._h._slot(key, create=True)
+        self._h._filled[slot] = True
+        getattr(self._h, self._array)[slot] = value
+
+    def __delitem__(self, key):
+        slot = self._h._slot(key)
+        if slot is None or not self._h._filled[slot]: raise KeyError(key)
+        self._h._filled[slot] = False
+        self._h._w[slot] = 0.
+        if self._h._w2 is not None: self._h._w2[slot] = 0.
+
+    def __contains__(self, key):
+        slot = self._h._slot(key)
+        return slot is not None and bool(self._h._filled[slot])
+
+    def __iter__(self):
+        axes = self._h.sparse_axes()
+        for slot in np.argwhere(self._h._filled):
+            yield tuple(ax.index(self._h._labels[i][j]) for i, (ax, j) in enumerate(zip(axes, slot)))
+
+    def __len__(self):
+        return int(self._h._filled.sum())
+
+class DenseHist(hist.Hist):
+
+    @property
+    def _sumw(self):
+        return DenseSums(self, '_w')
+
+    @_sumw.setter
+    def _sumw(self, sumw):
+        nsparse = len(self.sparse_axes())
+        self._labels = [[] for i in range(nsparse)]
+        self._lookup = [{} for i in range(nsparse)]
+        self._filled = np.zeros((0,)*nsparse, dtype=bool)
+        self._w = np.zeros((0,)*nsparse+self._dense_shape, dtype=self._dtype)
+        if getattr(self, '_w2', None) is not None: self._w2 = np.zeros_like(self._w)
+        for key, value in sumw.items(): self._sumw[key] = value
+
+    @property
+    def _sumw2(self):
+        return None if self._w2 is None else DenseSums(self, '_w2')
+
+    @_sumw2.setter
+    def _sumw2(self, sumw2):
+        self._w2 = None if sumw2 is None else np.zeros_like(self._w)
+        if sumw2 is None: return
+        for key, value in sumw2.items(): self._sumw2[key] = value
+
+    def _index(self, iaxis, label, create=False):
+        # Position of a label along a sparse axis, labels are interned on first use
+        # and the storage grows by doubling along that axis when it runs out of room
+        name = getattr(label, 'name', label)
+        lookup = self._lookup[iaxis]
+        if name in lookup or not create: return lookup.get(name)
+        self.sparse_axes()[iaxis].index(name)
+        lookup[name] = len(self._labels[iaxis])
+        self._labels[iaxis].append(name)
+        if lookup[name] == self._filled.shape[iaxis]:
+            def grow(array):
+                pad = [(0, 0)]*array.ndim
+                pad[iaxis] = (0, max(1, array.shape[iaxis]))
+                return np.pad(array, pad)
+            self._filled = grow(self._filled)
+            self._w = grow(self._w)
+            if self._w2 is not None: self._w2 = grow(self._w2)
+        return lookup[name]
+
+    def _slot(self, key, create=False):
+        slot = tuple(self._index(iaxis, label, create) for iaxis, label in enumerate(key))
+        return None if None in slot else slot
+
+    def _used(self):
+        return tuple(slice(0, len(labels)) for labels in self._labels)
+
+    def _init_sumw2(self):
+        self._w2 = self._w.copy()
+
+    def copy(self, content=True):
+        out = DenseHist(self._label, *self._axes, dtype=self._dtype)
+        if content:
+            out.__dict__.update(copy.deepcopy({name: self.__getstate__()[name] for name in ('_labels', '_lookup', '_filled', '_w', '_w2')}))
+        elif self._w2 is not None:
+            out._init_sumw2()
+        return out
+
+    def add(self, other):
+        if not isinstance(other, DenseHist):
+            return super().add(other)
+        if not self.compatible(other):
+            raise ValueError("Cannot add this histogram with histogram %r of dissimilar dimensions" % other)
+        # Map the labels of other onto the ones of this histogram, then add the arrays
+        onames = [ax.name for ax in other.sparse_axes()]
+        order = [onames.index(ax.name) for ax in self.sparse_axes()]
+        maps = [np.array([self._index(i, name, create=True) for name in other._labels[j]], dtype=np.int64) for i, j in enumerate(order)]
+        slots = np.ix_(*maps) if maps else ()
+        transpose = lambda array: array[other._used()].transpose(order+list(range(len(order), array.ndim)))
+        if self._w2 is None and other._w2 is not None: self._init_sumw2()
+        self._filled[slots] |= transpose(other._filled)
+        if self._w2 is not None: self._w2[slots] += transpose(other._w if other._w2 is None else other._w2)
+        self._w[slots] += transpose(other._w)
+        return self
+
+    def scale(self, factor, axis=None):
+        if self._w2 is None: self._init_sumw2()
+        if isinstance(factor, numbers.Number) and axis is None:
+            self._w *= factor
+            self._w2 *= factor**2
+        elif isinstance(factor, dict):
+            iaxis = self._isparse(self.axis(axis))
+            f = np.ones(self._filled.shape[iaxis])
+            for label, value in factor.items():
+                index = self._index(iaxis, label)
+                if index is not None: f[index] = value
+            f = f.reshape([-1 if i == iaxis else 1 for i in range(self._w.ndim)])
+            self._w *= f
+            self._w2 *= f**2
+        else:
+            super().scale(factor, axis)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        used = self._used()
+        for name in ('_filled', '_w', '_w2'):
+            if state[name] is not None: state[name] = state[name][used]
+        return state
+
+class DenseOutput(processor.dict_accumulator):
+    # Output holding DenseHist histograms. DenseHist is shipped by value inside
+    # data/common.coffea and cannot be looked up by reference when executors pickle
+    # their output, so the output goes as an empty DenseOutput, pickled by value with
+    # cloudpickle, and its content as one cloudpickle payload restored by __setstate__:
+    # each class is serialized once per output, not once per histogram
+
+    def identity(self):
+        return DenseOutput((key, value.identity()) for key, value in self.items())
+
+    def __reduce_ex__(self, protocol):
+        if not self: return super().__reduce_ex__(protocol)
+        return (cloudpickle.loads, (cloudpickle.dumps(type(self)(), protocol=protocol),), cloudpickle.dumps(dict(self), protocol=protocol))
+
+    def __setstate__(self, state):
+        if isinstance(state, bytes): self.update(cloudpickle.loads(state))
+
+###
+# Histogram fill engine: every variable is binned once per chunk, fills only
+# gather the cached bin indices of the selected entries and accumulate them
+# with a single bincount straight into the DenseHist arrays
+###
+
+class HistFiller:
+
+    def __init__(self, hout, size, restricted=None):
+        # restricted maps category labels to the only histograms filled with them
+        self._hout = hout
+        self._size = size
+        self._restricted = {} if restricted is None else restricted
+        self._groups = {}
+
+    def __contains__(self, group):
+        return group in self._groups
+
+    def bin(self, group, variables, extends=None, mask=None):
+        # Variables are either flat per-event arrays or jagged arrays with at most
+        # one entry per event, the dense axis of each histogram is named after it.
+        # All the histograms of a group share one index space, each owning a
+        # contiguous slice of it. A group can extend an already binned one: it only
+        # stores its own variables and a reference to it, filling the group fills both.
+        # If a mask is given, variables are evaluated only for the events passing it
+        # and the group can only be filled with cuts selecting a subset of those
+        events = np.arange(self._size) if mask is None else np.flatnonzero(mask)
+        entries, indices, valid, slices, nbins = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=bool)], {}, 0
+        for histname, values in variables.items():
+            if histname not in self._hout: continue
+            h = self._hout[histname]
+            if isinstance(values, awkward.JaggedArray):
+                entry = np.repeat(events, values.counts)
+                values = values.flatten()
+            else:
+                entry = events
+                values = np.asarray(values)
+            entries.append(entry)
+            indices.append(nbins + h.axis(histname).index(values))
+            valid.append(~np.isnan(values))
+            size = int(np.prod(h._dense_shape))
+            slices[histname] = slice(nbins, nbins+size)
+            nbins += size
+        self._groups[group] = (extends, np.concatenate(entries), np.concatenate(indices), np.concatenate(valid), slices, nbins)
+
+    def fill(self, group, weight, cut, **categories):
+        # Categories are either a single label, a (labels, codes) pair routing each
+        # event to labels[code], or a list of labels naming the columns of a two
+        # dimensional (events x variations) weight. Codes with a second dimension
+        # route an event to several labels at once. All the label combinations of
+        # all the weight columns come out of one bincount per column over the same
+        # bin indices, and are added to each DenseHist array in one go. As with
+        # hist.Hist.fill, every label combination is created even without entries,
+        # except for restricted labels in the histograms they are not meant for
+        while group is not None:
+            group, entries, indices, valid, slices, nbins = self._groups[group]
+            self._fill(entries, indices, valid, slices, nbins, weight, cut, categories)
+
+    def _fill(self, entries, indices, valid, slices, nbins, weight, cut, categories):
+        selected = cut[entries]
+        entry = entries[selected]
+        rows = np.arange(entry.size)
+        combo = np.zeros(entry.size, dtype=np.int64)
+        labels = {}
+        for name, category in categories.items():
+            if not isinstance(category, tuple): continue
+            labels[name], codes = category
+            codes = np.asarray(codes)[entry][rows]
+            if codes.ndim == 2:
+                rows = np.repeat(rows, codes.shape[1])
+                combo = np.repeat(combo, codes.shape[1])
+                codes = codes.ravel()
+            combo = combo*len(labels[name]) + codes
+        shape = [len(l) for l in labels.values()]
+        ncombos = int(np.prod(shape))
+        index = combo*nbins + indices[selected][rows]
+        weight = (weight.reshape(weight.shape[0], -1)[entry]*valid[selected][:, np.newaxis])[rows]
+        sumw = np.stack([np.bincount(index, weights=w, minlength=ncombos*nbins) for w in weight.T]).reshape(-1, ncombos, nbins)
+        sumw2 = np.stack([np.bincount(index, weights=w**2, minlength=ncombos*nbins) for w in weight.T]).reshape(-1, ncombos, nbins)
+        digits = dict(zip(labels, np.unravel_index(np.arange(ncombos), shape))) if labels else {}
+        for histname, s in slices.items():
+            # Weight columns whose labels are meant for this histogram
+            columns = list(range(sumw.shape[0]))
+            for category in categories.values():
+                if isinstance(category, list):
+                    columns = [c for c in columns if histname in self._restricted.get(category[c], [histname])]
+                elif not isinstance(category, tuple) and histname not in self._restricted.get(category, [histname]):
+                    columns = []
+            if not columns: continue
+            h = self._hout[histname]
+            if h._w2 is None: h._init_sumw2()
+            # Position of every (weight column, label combination) in the DenseHist arrays
+            slot = []
+            for iaxis, ax in enumerate(h.sparse_axes()):
+                category = categories[ax.name]
+                if isinstance(category, tuple):
+                    positions = np.array([h._index(iaxis, label, create=True) for label in labels[ax.name]])
+                    slot.append(positions[digits[ax.name]][np.newaxis, :])
+                elif isinstance(category, list):
+                    slot.append(np.array([h._index(iaxis, category[c], create=True) for c in columns])[:, np.newaxis])
+                else:
+                    slot.append(np.array([[h._index(iaxis, category, create=True)]]))
+            slot = tuple(np.broadcast_arrays(*slot))
+            h._filled[slot] = True
+            np.add.at(h._w, slot, sumw[columns][:, :, s].reshape(slot[0].shape+h._dense_shape))
+            np.add.at(h._w2, slot, sumw2[columns][:, :, s].reshape(slot[0].shape+h._dense_shape))
+
+###
+# Selection planner: the cuts of each region are ordered by the number of regions
+# requiring them, so that regions share the longest possible prefixes. Each distinct
+# prefix is evaluated once, with packed bit operations over the events passing the
+# prefix one cut shorter. Regions requiring the same cuts share one cached mask
+###
+
+class SelectionPlan:
+
+    def __init__(self, selection, regions):
+        self._selection = selection
+        self._regions = regions
+        usage = {}
+        for cuts in regions.values():
+            for name in cuts: usage[name] = usage.get(name, 0) + 1
+        self._order = sorted(usage, key=lambda name: (-usage[name], selection.names.index(name)))
+        self._prefixes = {}
+        self._masks = {}
+
+    def _passing(self, prefix):
+        # Indices and packed bits of the events passing a prefix of cuts
+        if prefix not in self._prefixes:
+            if not prefix:
+                packed = self._selection._mask
+                self._prefixes[prefix] = (np.arange(packed.size), packed)
+            else:
+                events, packed = self._passing(prefix[:-1])
+                bit = 1 << self._selection.names.index(prefix[-1])
+                keep = (packed & bit) == bit
+                self._prefixes[prefix] = (events[keep], packed[keep])
+        return self._prefixes[prefix]
+
+    def all(self, region):
+        prefix = tuple(sorted(self._regions[region], key=self._order.index))
+        if prefix not in self._masks:
+            mask = np.zeros(self._selection._mask.shape, dtype=bool)
+            mask[self._passing(prefix)[0]] = True
+            self._masks[prefix] = mask
+        return self._masks[prefix]
+
+###
+# Event weights in a given precision: processor.Weights starts from a float64 vector and
+# corrections come out of the lookups in float64, this keeps the product and variations
+# in the requested dtype. Histogram sums are accumulated in float64 regardless
+###
+
+class Weights(processor.Weights):
+
+    def __init__(self, size, dtype=np.float64, storeIndividual=False):
+        super().__init__(size, storeIndividual)
+        self._dtype = np.dtype(dtype)
+        self._weight = self._weight.astype(self._dtype)
+
+    def add(self, name, weight, weightUp=None, weightDown=None, shift=False):
+        cast = lambda w: None if w is None else np.asarray(w, dtype=self._dtype)
+        super().add(name, cast(weight), cast(weightUp), cast(weightDown), shift)
+
+def weight_matrix(weights, modifiers):
+    # processor.Weights variations as an (events x variations) matrix, None being the nominal weight
+    return np.stack([weights.weight(modifier=modifier) for modifier in modifiers], axis=1)
+
+###
+# Systematic variations filled only into the listed histograms, every other label goes
+# to all of them: the pileup variations are only needed for the recoil fit variable
+###
+
+systematic_histograms = {
+    'pileupUp': ['recoil'],
+    'pileupDown': ['recoil'],
+}
+
 common = {}
 common['match'] = match
+common['vetoes'] = vetoes
+common['clean'] = clean
+common['leading_pair'] = leading_pair
+common['min_dphi'] = min_dphi
+common['pack_flags'] = pack_flags
+common['has_flags'] = has_flags
+common['gen_ancestry'] = gen_ancestry
+common['fatjet_gen_labels'] = fatjet_gen_labels
 common['btagWPs'] = btagWPs
+common['DenseHist'] = DenseHist
+common['DenseOutput'] = DenseOutput
+common['HistFiller'] = HistFiller
+common['Weights'] = Weights
+common['weight_matrix'] = weight_matrix
+common['SelectionPlan'] = SelectionPlan
+common['systematic_histograms'] = systematic_histograms
 save(common, 'data/common.coffea')
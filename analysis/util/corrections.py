@@ -1,17 +1,34 @@
 #!/usr/bin/env python
 import uproot, uproot_methods
 import numpy as np
+import awkward
 import os
 from coffea.arrays import Initialize
 from coffea import hist, lookup_tools
 from coffea.lookup_tools import extractor, dense_lookup
 from coffea.util import save, load
 from coffea.btag_tools import BTagScaleFactor
+from coffea.jetmet_tools import FactorizedJetCorrector, JetCorrectionUncertainty, JetResolution, JetResolutionScaleFactor
 
 
+###
+# Pileup weights as a table indexed by the number of primary vertices, with the central,
+# up and down weights side by side: npvs is a small non-negative integer, so evaluating
+# all three is one gather, npvs beyond the last bin get the weights of the last bin
+###
+
+class PileupWeight:
+
+    def __init__(self, cen, up, down, edges):
+        npvs = np.arange(int(np.ceil(edges[-1])) + 1)
+        bins = np.clip(np.searchsorted(edges, npvs, side='right') - 1, 0, len(cen) - 1)
+        self._table = np.stack([cen[bins], up[bins], down[bins]], axis=1)
+
+    def __call__(self, npvs):
+        weights = self._table[np.clip(np.asarray(npvs), 0, len(self._table) - 1)]
+        return weights[:, 0], weights[:, 1], weights[:, 2]
+
 get_pu_weight = {}
-get_pu_weight['2017'] = {}
-get_pu_weight['2018'] = {}
 
 pu = {}
 pu["2018"] = uproot.open("data/pileup/puWeights_10x_56ifb.root")
@@ -19,13 +36,8 @@ pu["2017"] = uproot.open("data/pileup/puWeights_90x_41ifb.root")
 pu["2016"] = uproot.open("data/pileup/puWeights_80x_37ifb.root")
 for year in ['2016','2017','2018']:
     fpu = pu[year]
-    pu_cen = fpu["puWeights"].values
-    pu_up = fpu["puWeightsUp"].values
-    pu_down= fpu["puWeightsDown"].values
-    get_pu_weight[year] = {}
-    get_pu_weight[year]['cen'] = lookup_tools.dense_lookup.dense_lookup(pu_cen, fpu["puWeights"].edges)
-    get_pu_weight[year]['up'] = lookup_tools.dense_lookup.dense_lookup(pu_up, fpu["puWeightsUp"].edges)    
-    get_pu_weight[year]['down'] = lookup_tools.dense_lookup.dense_lookup(pu_down, fpu["puWeightsDown"].edges)
+    assert np.array_equal(fpu["puWeightsUp"].edges, fpu["puWeights"].edges) and np.array_equal(fpu["puWeightsDown"].edges, fpu["puWeights"].edges)
+    get_pu_weight[year] = PileupWeight(fpu["puWeights"].values, fpu["puWeightsUp"].values, fpu["puWeightsDown"].values, fpu["puWeights"].edges)
 
 get_met_trig_weight = {}
 
@@ -140,6 +152,77 @@ get_mu_loose_iso_sf['2017'] = lookup_tools.dense_lookup.dense_lookup(mu_iso2017[
 get_mu_tight_iso_sf['2018'] = lookup_tools.dense_lookup.dense_lookup(mu_iso2018["NUM_TightRelIso_DEN_TightIDandIPCut_pt_abseta"].values,mu_iso2018["NUM_TightRelIso_DEN_TightIDandIPCut_pt_abseta"].edges)
 get_mu_loose_iso_sf['2018'] = lookup_tools.dense_lookup.dense_lookup(mu_iso2018["NUM_LooseRelIso_DEN_LooseID_pt_abseta"].values,mu_iso2018["NUM_LooseRelIso_DEN_LooseID_pt_abseta"].edges)
 
+###
+# Lepton ID, isolation, reconstruction and trigger tables evaluated together on the same
+# per-event leg kinematics. The group is built from the histograms behind the single
+# lookups above: tables with the same edges share one digitization of the arguments,
+# each table is then a single gather with those bin indices
+###
+
+class LookupGroup:
+
+    def __init__(self, histograms):
+        self._values = {}
+        self._binnings = []
+        self._binning = {}
+        for name, h in histograms.items():
+            values = np.asarray(h.values)
+            edges = h.edges if values.ndim > 1 else [h.edges]
+            binning = (tuple(np.asarray(edge) for edge in edges), values.shape)
+            for i, other in enumerate(self._binnings):
+                if other[1] == binning[1] and all(np.array_equal(a, b) for a, b in zip(other[0], binning[0])):
+                    break
+            else:
+                i = len(self._binnings)
+                self._binnings.append(binning)
+            self._binning[name] = i
+            self._values[name] = values
+
+    def __call__(self, names, *args):
+        args = [np.asarray(arg) for arg in args]
+        indices = {}
+        out = {}
+        for name in names:
+            i = self._binning[name]
+            if i not in indices:
+                edges, shape = self._binnings[i]
+                indices[i] = tuple(np.clip(np.searchsorted(edge, arg, side='right') - 1, 0, n - 1) for edge, arg, n in zip(edges, args, shape))
+            out[name] = self._values[name][indices[i]]
+        return out
+
+lepton_histograms = {}
+for year in ['2016','2017','2018']:
+    lepton_histograms[year] = {
+        'ele_trig'         : ele_trig[year]["hEffEtaPt"],
+        'ele_loose_id_sf'  : ele_loose[year]["EGamma_SF2D"],
+        'ele_tight_id_sf'  : ele_tight[year]["EGamma_SF2D"],
+        'ele_loose_id_eff' : ele_loose[year]["EGamma_EffMC2D"],
+        'ele_tight_id_eff' : ele_tight[year]["EGamma_EffMC2D"],
+        'ele_reco_sf'      : ele_reco[year]["EGamma_SF2D"],
+    }
+lepton_histograms['2016'].update({
+    'mu_tight_id_sf'   : mu_id2016["NUM_TightID_DEN_genTracks_eta_pt"],
+    'mu_loose_id_sf'   : mu_id2016["NUM_LooseID_DEN_genTracks_eta_pt"],
+    'mu_tight_iso_sf'  : mu_iso2016["NUM_TightRelIso_DEN_TightIDandIPCut_eta_pt"],
+    'mu_loose_iso_sf'  : mu_iso2016["NUM_LooseRelIso_DEN_LooseID_eta_pt"],
+})
+lepton_histograms['2017'].update({
+    'mu_tight_id_sf'   : mu_id2017["NUM_TightID_DEN_genTracks_pt_abseta"],
+    'mu_loose_id_sf'   : mu_id2017["NUM_LooseID_DEN_genTracks_pt_abseta"],
+    'mu_tight_iso_sf'  : mu_iso2017["NUM_TightRelIso_DEN_TightIDandIPCut_pt_abseta"],
+    'mu_loose_iso_sf'  : mu_iso2017["NUM_LooseRelIso_DEN_LooseID_pt_abseta"],
+})
+lepton_histograms['2018'].update({
+    'mu_tight_id_sf'   : mu_id2018["NUM_TightID_DEN_TrackerMuons_pt_abseta"],
+    'mu_loose_id_sf'   : mu_id2018["NUM_LooseID_DEN_TrackerMuons_pt_abseta"],
+    'mu_tight_iso_sf'  : mu_iso2018["NUM_TightRelIso_DEN_TightIDandIPCut_pt_abseta"],
+    'mu_loose_iso_sf'  : mu_iso2018["NUM_LooseRelIso_DEN_LooseID_pt_abseta"],
+})
+
+get_lepton_weights = {}
+for year in ['2016','2017','2018']:
+    get_lepton_weights[year] = LookupGroup(lepton_histograms[year])
+
 get_nlo_weight = {}
 kfactor = uproot.open("data/nlo/kfactors.root")
 for year in ['2016','2017','2018']:
@@ -268,69 +351,43 @@ class BTagCorrector:
         nom = bpass / np.maximum(ball, 1.)
         self.eff = lookup_tools.dense_lookup.dense_lookup(nom, [ax.edges() for ax in btag[tagger].axes()[3:]])
 
-    def btag_weight(self, pt, eta, flavor, tag):
-        abseta = abs(eta)
-        
+    def btag_weights(self, pt, eta, flavor):
+        ###
+        # All the jets are looked up once as flat arrays: one efficiency lookup and one
+        # scale factor evaluation per systematic. The no-tag probabilities give both the
+        # 0-tag and the >=1-tag (nominal, up, down) weights, returned by tag
+        ###
+        counts = np.asarray(pt.counts)
+        _pt, _abseta, _flavor = np.asarray(pt.flatten()), np.asarray(abs(eta.flatten())), np.asarray(flavor.flatten())
+
         #https://twiki.cern.ch/twiki/bin/viewauth/CMS/BTagSFMethods#1b_Event_reweighting_using_scale
         def zerotag(eff):
-            return (1 - eff).prod()
-
-        eff = self.eff(flavor, pt, abseta)
-        sf_nom = self.sf.eval('central', flavor, abseta, pt)
-        sf_up = self.sf.eval('up', flavor, abseta, pt)
-        sf_down = self.sf.eval('down', flavor, abseta, pt)
-
-        eff_data_nom  = np.minimum(1., sf_nom*eff)
-        eff_data_up   = np.minimum(1., sf_up*eff)
-        eff_data_down = np.minimum(1., sf_down*eff)
-
-        nom = zerotag(eff_data_nom)/zerotag(eff)
-        up = zerotag(eff_data_up)/zerotag(eff)
-        down = zerotag(eff_data_down)/zerotag(eff)
-
-        if '-1' in tag: 
-            nom = (1 - zerotag(eff_data_nom)) / (1 - zerotag(eff))
-            up = (1 - zerotag(eff_data_up)) / (1 - zerotag(eff))
-            down = (1 - zerotag(eff_data_down)) / (1 - zerotag(eff))
-
-        return np.nan_to_num(nom), np.nan_to_num(up), np.nan_to_num(down)
-
-get_btag_weight = {
-    'deepflav': {
-        '2016': {
-            'loose'  : BTagCorrector('deepflav','2016','loose').btag_weight,
-            'medium' : BTagCorrector('deepflav','2016','medium').btag_weight,
-            'tight'  : BTagCorrector('deepflav','2016','tight').btag_weight
-        },
-        '2017': {
-            'loose'  : BTagCorrector('deepflav','2017','loose').btag_weight,
-            'medium' : BTagCorrector('deepflav','2017','medium').btag_weight,
-            'tight'  : BTagCorrector('deepflav','2017','tight').btag_weight
-        },
-        '2018': {
-            'loose'  : BTagCorrector('deepflav','2018','loose').btag_weight,
-            'medium' : BTagCorrector('deepflav','2018','medium').btag_weight,
-            'tight'  : BTagCorrector('deepflav','2018','tight').btag_weight
-        }
-    },
-    'deepcsv' : {
-        '2016': {
-            'loose'  : BTagCorrector('deepcsv','2016','loose').btag_weight,
-            'medium' : BTagCorrector('deepcsv','2016','medium').btag_weight,
-            'tight'  : BTagCorrector('deepcsv','2016','tight').btag_weight
-        },
-        '2017': {
-            'loose'  : BTagCorrector('deepcsv','2017','loose').btag_weight,
-            'medium' : BTagCorrector('deepcsv','2017','medium').btag_weight,
-            'tight'  : BTagCorrector('deepcsv','2017','tight').btag_weight
-        },
-        '2018': {
-            'loose'  : BTagCorrector('deepcsv','2018','loose').btag_weight,
-            'medium' : BTagCorrector('deepcsv','2018','medium').btag_weight,
-            'tight'  : BTagCorrector('deepcsv','2018','tight').btag_weight
-        }
-    }
-}
+            return awkward.JaggedArray.fromcounts(counts, 1 - eff).prod()
+
+        eff = self.eff(_flavor, _pt, _abseta)
+        zerotag_mc = zerotag(eff)
+        weights = {'0': [], '-1': []}
+        for systematic in ['central', 'up', 'down']:
+            zerotag_data = zerotag(np.minimum(1., self.sf.eval(systematic, _flavor, _abseta, _pt)*eff))
+            weights['0'].append(np.nan_to_num(zerotag_data/zerotag_mc))
+            weights['-1'].append(np.nan_to_num((1 - zerotag_data)/(1 - zerotag_mc)))
+        return {tag: tuple(weight) for tag, weight in weights.items()}
+
+    def btag_weight(self, pt, eta, flavor, tag):
+        return self.btag_weights(pt, eta, flavor)['-1' if '-1' in tag else '0']
+
+get_btag_weight = {}
+get_btag_weights = {}
+for tagger in ['deepflav','deepcsv']:
+    get_btag_weight[tagger] = {}
+    get_btag_weights[tagger] = {}
+    for year in ['2016','2017','2018']:
+        get_btag_weight[tagger][year] = {}
+        get_btag_weights[tagger][year] = {}
+        for workingpoint in ['loose','medium','tight']:
+            btag_corrector = BTagCorrector(tagger,year,workingpoint)
+            get_btag_weight[tagger][year][workingpoint] = btag_corrector.btag_weight
+            get_btag_weights[tagger][year][workingpoint] = btag_corrector.btag_weights
 
 Jetext = extractor()
 for directory in ['jec', 'jersf', 'jr', 'junc']:
@@ -338,7 +395,7 @@ for directory in ['jec', 'jersf', 'jr', 'junc']:
     print('Loading files in:',directory)
     for filename in os.listdir(directory):
         if '~' in filename: continue
-        if 'AK4PFPuppi' not in filename: continue
+        if 'AK4PFPuppi' not in filename and 'AK8PFPuppi' not in filename: continue
         if 'DATA' in filename: continue
         filename=directory+'/'+filename
         print('Loading file:',filename)
@@ -347,6 +404,65 @@ for directory in ['jec', 'jersf', 'jr', 'junc']:
 Jetext.finalize()
 Jetevaluator = Jetext.make_evaluator()
 
+###
+# Jet energy corrections: JEC, JES uncertainty, JER and JER scale factor correctors are
+# built once, when the processor is, and evaluated on the flat jet content. Corrected
+# pt/mass and, unless variations=False, the JES/JER shifted pt/mass come out as flat
+# columns, jets are not copied. The AK8PFPuppi set is loaded alongside the AK4PFPuppi one
+# and corrects the AK15 jets
+###
+
+def jet_gaussian(seed):
+    # Standard normal number per jet, derived only from its (run, lumi, event, jet index)
+    # seed: splitmix64 hashing of the seed words and Box-Muller on two hashed uniforms,
+    # so smearing does not depend on which other jets or events are in the chunk
+    def mix(x):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+    with np.errstate(over='ignore'):
+        h = np.zeros(len(seed), dtype=np.uint64)
+        for word in np.asarray(seed, dtype=np.uint64).T:
+            h = mix(h + np.uint64(0x9e3779b97f4a7c15) + word)
+        u1 = (mix(h) >> np.uint64(11)) * 2.**-53
+        u2 = (mix(h ^ np.uint64(0x9e3779b97f4a7c15)) >> np.uint64(11)) * 2.**-53
+    return np.sqrt(-2.*np.log1p(-u1))*np.cos(2.*np.pi*u2)
+
+class JetCorrector:
+
+    def __init__(self, evaluator, jec, junc, jr, jersf):
+        self._jec = FactorizedJetCorrector(**{name: evaluator[name] for name in jec})
+        self._junc = JetCorrectionUncertainty(**{name: evaluator[name] for name in junc})
+        self._jr = JetResolution(**{name: evaluator[name] for name in jr})
+        self._jersf = JetResolutionScaleFactor(**{name: evaluator[name] for name in jersf})
+
+    def corrected(self, ptRaw, massRaw, eta, area, rho, ptGenJet, seed, variations=True):
+        inputs = {'JetEta': eta, 'JetA': area, 'Rho': rho, 'JetPt': ptRaw}
+        args = lambda corrector: {key: inputs[key] for key in corrector.signature}
+        jec = self._jec.getCorrection(**args(self._jec))
+        pt, mass = jec*ptRaw, jec*massRaw
+        inputs['JetPt'] = pt
+        ###
+        # Hybrid smearing: scaling against the matched gen jet (ptGenJet>0), stochastic
+        # otherwise, with the random number of each jet set by its seed (see jet_gaussian).
+        # Scale factor columns are nominal, down, up
+        ###
+        resolution = self._jr.getResolution(**args(self._jr))
+        sf = self._jersf.getScaleFactor(**args(self._jersf))
+        stochastic = 1. + np.sqrt(np.maximum(sf**2 - 1., 0.))*(resolution*jet_gaussian(seed))[:, None]
+        hybrid = 1. + (sf - 1.)*((pt - ptGenJet)/pt)[:, None]
+        smear = np.maximum(np.where((ptGenJet > 0)[:, None], hybrid, stochastic), 0.)
+        out = {}
+        out['pt'], out['mass'] = smear[:, 0]*pt, smear[:, 0]*mass
+        if not variations: return out
+        out['pt_jerUp'], out['mass_jerUp'] = smear[:, 2]*pt, smear[:, 2]*mass
+        out['pt_jerDown'], out['mass_jerDown'] = smear[:, 1]*pt, smear[:, 1]*mass
+        inputs['JetPt'] = out['pt']
+        (level, jes), = self._junc.getUncertainty(**args(self._junc))
+        out['pt_jesUp'], out['mass_jesUp'] = jes[:, 0]*out['pt'], jes[:, 0]*out['mass']
+        out['pt_jesDown'], out['mass_jesDown'] = jes[:, 1]*out['pt'], jes[:, 1]*out['mass']
+        return out
+
 corrections = {}
 corrections['get_msd_weight']          = get_msd_weight
 corrections['get_ttbar_weight']        = get_ttbar_weight
@@ -369,9 +485,12 @@ corrections['get_mu_loose_id_sf']      = get_mu_loose_id_sf
 corrections['get_ele_reco_sf']         = get_ele_reco_sf
 corrections['get_mu_tight_iso_sf']     = get_mu_tight_iso_sf
 corrections['get_mu_loose_iso_sf']     = get_mu_loose_iso_sf
+corrections['get_lepton_weights']      = get_lepton_weights
 corrections['get_ecal_bad_calib']      = get_ecal_bad_calib
 corrections['get_btag_weight']         = get_btag_weight
+corrections['get_btag_weights']        = get_btag_weights
 corrections['Jetevaluator']            = Jetevaluator
+corrections['JetCorrector']            = JetCorrector
 
 save(corrections, 'data/corrections.coffea')
 
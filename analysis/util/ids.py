@@ -1,6 +1,7 @@
 import awkward
 import uproot, uproot_methods
 import numpy as np
+import numba
 from coffea.util import save
 
 #POG  Tight - https://twiki.cern.ch/twiki/bin/view/CMS/CutBasedElectronIdentificationRun2?rev=41#Offline_selection_criteria
@@ -97,6 +98,70 @@ def isHEMJet(pt, eta, phi):
     mask = (pt>30) & ((eta>-3.0)&(eta<-1.3)) & ((phi>-1.57)&(phi<-0.87))
     return mask
 
+###
+# Fused IDs: every working point of a collection is evaluated in a single pass over the
+# flat content, abs(eta) and the barrel/endcap split computed once per object. The year
+# dependence is carried by the thresholds and ID encodings passed to the kernels
+###
+
+@numba.njit
+def electron_id_kernel(pt, eta, dxy, dz, cutBased, tight_pt):
+    loose = np.zeros(pt.size, dtype=np.bool_)
+    tight = np.zeros(pt.size, dtype=np.bool_)
+    for i in range(pt.size):
+        aeta = abs(eta[i])
+        if aeta < 1.4442:
+            ip = abs(dxy[i]) < 0.05 and abs(dz[i]) < 0.1
+        elif aeta > 1.4442 and aeta < 2.5:
+            ip = abs(dxy[i]) < 0.1 and abs(dz[i]) < 0.2
+        else:
+            ip = False
+        loose[i] = ip and pt[i] > 10 and cutBased[i] >= 1
+        tight[i] = ip and pt[i] > tight_pt and cutBased[i] == 4
+    return loose, tight
+
+@numba.njit
+def muon_id_kernel(pt, eta, iso, loose_id, tight_id):
+    loose = np.zeros(pt.size, dtype=np.bool_)
+    tight = np.zeros(pt.size, dtype=np.bool_)
+    for i in range(pt.size):
+        if not abs(eta[i]) < 2.4: continue
+        loose[i] = pt[i] > 10 and loose_id[i] > 0 and iso[i] < 0.25
+        tight[i] = pt[i] > 20 and tight_id[i] > 0 and iso[i] < 0.15
+    return loose, tight
+
+@numba.njit
+def photon_id_kernel(pt, eta, _id, bitmap):
+    loose = np.zeros(pt.size, dtype=np.bool_)
+    tight = np.zeros(pt.size, dtype=np.bool_)
+    for i in range(pt.size):
+        aeta = abs(eta[i])
+        if bitmap:
+            isloose, istight = (_id[i] & 1) == 1, (_id[i] & 2) == 2
+        else:
+            isloose, istight = _id[i] >= 1, _id[i] == 3
+        loose[i] = pt[i] > 15 and aeta < 2.5 and isloose
+        tight[i] = pt[i] > 230 and aeta < 1.4442 and istight
+    return loose, tight
+
+def fused(kernel, *args):
+    counts = args[0].counts
+    flat = [np.asarray(arg.flatten()) for arg in args if isinstance(arg, awkward.JaggedArray)]
+    extra = [arg for arg in args if not isinstance(arg, awkward.JaggedArray)]
+    return tuple(awkward.JaggedArray.fromcounts(counts, mask) for mask in kernel(*(flat+extra)))
+
+electron_tight_pt = {'2016': 29., '2017': 34., '2018': 34.}
+
+def electronIDs(pt,eta,dxy,dz,cutBased,year):
+    return fused(electron_id_kernel, pt, eta, dxy, dz, cutBased, electron_tight_pt[year])
+
+def muonIDs(pt,eta,iso,loose_id,tight_id,year):
+    return fused(muon_id_kernel, pt, eta, iso, loose_id, tight_id)
+
+#2016 uses Photon_cutBased, later years Photon_cutBasedBitmap
+def photonIDs(pt,eta,_id,year):
+    return fused(photon_id_kernel, pt, eta, _id, year!='2016')
+
 ids = {}
 ids['isLooseElectron'] = isLooseElectron
 ids['isTightElectron'] = isTightElectron
@@ -108,4 +173,7 @@ ids['isTightPhoton']   = isTightPhoton
 ids['isGoodJet']       = isGoodJet
 ids['isGoodFatJet']    = isGoodFatJet
 ids['isHEMJet']        = isHEMJet
+ids['electronIDs']     = electronIDs
+ids['muonIDs']         = muonIDs
+ids['photonIDs']       = photonIDs
 save(ids, 'data/ids.coffea')
@@ -9,7 +9,6 @@ np.seterr(divide='ignore', invalid='ignore', over='ignore')
 from coffea.arrays import Initialize
 from coffea import hist, processor
 from coffea.util import load, save
-from coffea.jetmet_tools import FactorizedJetCorrector, JetCorrectionUncertainty, JetTransformer, JetResolution, JetResolutionScaleFactor
 from optparse import OptionParser
 from uproot_methods import TVector2Array, TLorentzVectorArray
 
@@ -266,6 +265,18 @@ class AnalysisProcessor(processor.ProcessorABC):
             ]
         }
 
+        ###
+        # Jet correctors are built once here rather than in every process() call
+        ###
+
+        self._jet_corrector = corrections['JetCorrector'](
+            corrections['Jetevaluator'],
+            self._jec[year],
+            self._junc[year],
+            self._jr[year],
+            self._jersf[year]
+        )
+
         self._corrections = corrections
         self._ids = ids
         self._common = common
@@ -467,8 +478,7 @@ class AnalysisProcessor(processor.ProcessorABC):
         get_mu_tight_iso_sf     = self._corrections['get_mu_tight_iso_sf'][self._year]
         get_mu_loose_iso_sf     = self._corrections['get_mu_loose_iso_sf'][self._year]
         get_ecal_bad_calib      = self._corrections['get_ecal_bad_calib']
-        get_deepflav_weight     = self._corrections['get_btag_weight']['deepflav'][self._year]
-        Jetevaluator            = self._corrections['Jetevaluator']
+        get_deepflav_weights    = self._corrections['get_btag_weights']['deepflav'][self._year]
         
         isLooseElectron = self._ids['isLooseElectron'] 
         isTightElectron = self._ids['isTightElectron'] 
@@ -482,19 +492,13 @@ class AnalysisProcessor(processor.ProcessorABC):
         isHEMJet        = self._ids['isHEMJet']        
         
         match = self._common['match']
+        vetoes = self._common['vetoes']
+        clean = self._common['clean']
+        leading_pair = self._common['leading_pair']
+        min_dphi = self._common['min_dphi']
         deepflavWPs = self._common['btagWPs']['deepflav'][self._year]
         deepcsvWPs = self._common['btagWPs']['deepcsv'][self._year]
 
-        ###
-        # Derive jet corrector for JEC/JER
-        ###
-        
-        JECcorrector = FactorizedJetCorrector(**{name: Jetevaluator[name] for name in self._jec[self._year]})
-        JECuncertainties = JetCorrectionUncertainty(**{name:Jetevaluator[name] for name in self._junc[self._year]})
-        JER = JetResolution(**{name:Jetevaluator[name] for name in self._jr[self._year]})
-        JERsf = JetResolutionScaleFactor(**{name:Jetevaluator[name] for name in self._jersf[self._year]})
-        Jet_transformer = JetTransformer(jec=JECcorrector,junc=JECuncertainties, jer = JER, jersf = JERsf)
-        
         ###
         #Initialize global quantities (MET ecc.)
         ###
@@ -535,7 +539,8 @@ class AnalysisProcessor(processor.ProcessorABC):
         leading_mu = leading_mu[leading_mu.istight.astype(np.bool)]
 
         tau = events.Tau
-        tau['isclean']=~match(tau,mu_loose,0.5)&~match(tau,e_loose,0.5)
+        lepton_veto = vetoes([(mu_loose,0.5),(e_loose,0.5)])
+        tau['isclean']=clean(tau,lepton_veto)
         tau['isloose']=isLooseTau(tau.pt,tau.eta,tau.idDecayMode,tau.idMVAoldDM2017v2,self._year)
         tau_clean=tau[tau.isclean.astype(np.bool)]
         tau_loose=tau_clean[tau_clean.isloose.astype(np.bool)]
@@ -543,7 +548,7 @@ class AnalysisProcessor(processor.ProcessorABC):
         tau_nloose=tau_loose.counts
 
         pho = events.Photon
-        pho['isclean']=~match(pho,mu_loose,0.5)&~match(pho,e_loose,0.5)
+        pho['isclean']=clean(pho,lepton_veto)
         _id = 'cutBasedBitmap'
         if self._year=='2016': _id = 'cutBased'
         pho['isloose']=isLoosePhoton(pho.pt,pho.eta,pho[_id],self._year)
@@ -561,17 +566,27 @@ class AnalysisProcessor(processor.ProcessorABC):
         leading_pho = leading_pho[leading_pho.istight.astype(np.bool)]
 
         j = events.Jet
+        j['ptRaw'] =j.pt * (1-j.rawFactor)
+        j['massRaw'] = j.mass * (1-j.rawFactor)
+        j['rho'] = j.pt.ones_like()*np.asarray(events.fixedGridRhoFastjetAll)
+        if not isData:
+            ###
+            # JEC/JER: pt and mass are replaced by the corrected ones before any selection.
+            # No JES/JER variations are filled here, so only the nominal correction is requested
+            ###
+            j['ptGenJet'] = j.matched_gen.pt.fillna(0.)
+            seed = np.stack([np.repeat(np.asarray(events[column]), j.counts).astype(np.uint64) for column in ['run', 'luminosityBlock', 'event']]+[j.localindex.flatten().astype(np.uint64), np.full(j.counts.sum(), 4, dtype=np.uint64)], axis=1)
+            corrected = self._jet_corrector.corrected(*[np.asarray(column.flatten()) for column in [j.ptRaw, j.massRaw, j.eta, j.area, j.rho, j.ptGenJet]], seed, variations=False)
+            for column, values in corrected.items():
+                j[column] = awkward.JaggedArray.fromcounts(j.counts, values)
         j['isgood'] = isGoodJet(j.pt, j.eta, j.jetId, j.neHEF, j.neEmEF, j.chHEF, j.chEmEF)
         j['isHEM'] = isHEMJet(j.pt, j.eta, j.phi)
-        j['isclean'] = ~match(j,e_loose,0.4)&~match(j,mu_loose,0.4)&~match(j,pho_loose,0.4)
+        j['isclean'] = clean(j,vetoes([(e_loose,0.4),(mu_loose,0.4),(pho_loose,0.4)]))
         #j['isiso'] = ~match(j,fj_clean,1.5)   # What is this ?????
         j['isdcsvL'] = (j.btagDeepB>deepcsvWPs['loose'])
         j['isdflvL'] = (j.btagDeepFlavB>deepflavWPs['loose'])
         j['T'] = TVector2Array.from_polar(j.pt, j.phi)
         j['p4'] = TLorentzVectorArray.from_ptetaphim(j.pt, j.eta, j.phi, j.mass)
-        j['ptRaw'] =j.pt * (1-j.rawFactor)
-        j['massRaw'] = j.mass * (1-j.rawFactor)
-        j['rho'] = j.pt.ones_like()*events.fixedGridRhoFastjetAll.array
         j_good = j[j.isgood.astype(np.bool)]
         j_clean = j_good[j_good.isclean.astype(np.bool)]  # USe this instead of j_iso Sunil
         #j_iso = j_clean[j_clean.isiso.astype(np.bool)]
@@ -594,17 +609,11 @@ class AnalysisProcessor(processor.ProcessorABC):
         #Calculating derivatives
         ###
 
-        ele_pairs = e_loose.distincts()
-        diele = ele_pairs.i0+ele_pairs.i1
-        diele['T'] = TVector2Array.from_polar(diele.pt, diele.phi)
-        leading_ele_pair = ele_pairs[diele.pt.argmax()]
-        leading_diele = diele[diele.pt.argmax()]
+        leading_diele = leading_pair(e_loose)
+        leading_diele['T'] = TVector2Array.from_polar(leading_diele.pt, leading_diele.phi)
 
-        mu_pairs = mu_loose.distincts()
-        dimu = mu_pairs.i0+mu_pairs.i1
-        dimu['T'] = TVector2Array.from_polar(dimu.pt, dimu.phi)
-        leading_mu_pair = mu_pairs[dimu.pt.argmax()]
-        leading_dimu = dimu[dimu.pt.argmax()]
+        leading_dimu = leading_pair(mu_loose)
+        leading_dimu['T'] = TVector2Array.from_polar(leading_dimu.pt, leading_dimu.phi)
 
         ###
         # Calculate recoil
@@ -612,8 +621,8 @@ class AnalysisProcessor(processor.ProcessorABC):
 
         um = met.T+leading_mu.T.sum()
         ue = met.T+leading_e.T.sum()
-        umm = met.T+leading_dimu.T.sum()
-        uee = met.T+leading_diele.T.sum()
+        umm = met.T+leading_dimu.T
+        uee = met.T+leading_diele.T
         ua = met.T+leading_pho.T.sum()
         #Need  help from Matteo
         u = {}
@@ -625,19 +634,13 @@ class AnalysisProcessor(processor.ProcessorABC):
         u['zecr']=uee
         u['zmcr']=umm
         u['gcr']=ua
+        u_mindphi = min_dphi({r: u[r].phi for r in u}, j_clean.phi)
 
         ###
         #Calculating weights
         ###
         if not isData:
             
-            ###
-            # JEC/JER
-            ###
-
-            #j['ptGenJet'] = j.matched_gen.pt
-            #Jet_transformer.transform(j)
-
             gen = events.GenPart
             
             #Need to understand this part Sunil
@@ -682,16 +685,14 @@ class AnalysisProcessor(processor.ProcessorABC):
             # Calculate PU weight and systematic variations
             ###
 
-            pu = get_pu_weight['cen'](events.PV.npvs)
-            #puUp = get_pu_weight['up'](events.PV.npvs)
-            #puDown = get_pu_weight['down'](events.PV.npvs)
+            pu, puUp, puDown = get_pu_weight(events.PV.npvs)
 
             ###
             # Trigger efficiency weight
             ###
             
-            ele1_trig_weight = get_ele_trig_weight(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            ele2_trig_weight = get_ele_trig_weight(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            ele1_trig_weight = get_ele_trig_weight(leading_diele.eta0,leading_diele.pt0)
+            ele2_trig_weight = get_ele_trig_weight(leading_diele.eta1,leading_diele.pt1)
 
             # Need Help from Matteo
             trig = {}
@@ -709,31 +710,31 @@ class AnalysisProcessor(processor.ProcessorABC):
             ##
 
             mueta = abs(leading_mu.eta.sum())
-            mu1eta=abs(leading_mu_pair.i0.eta.sum())
-            mu2eta=abs(leading_mu_pair.i1.eta.sum())
+            mu1eta=abs(leading_dimu.eta0)
+            mu2eta=abs(leading_dimu.eta1)
             if self._year=='2016':
                 mueta=leading_mu.eta.sum()
-                mu1eta=leading_mu_pair.i0.eta.sum()
-                mu2eta=leading_mu_pair.i1.eta.sum()
+                mu1eta=leading_dimu.eta0
+                mu2eta=leading_dimu.eta1
 
             ### 
             # Calculating electron and muon ID SF and efficiencies (when provided)
             ###
 
-            mu1Tsf = get_mu_tight_id_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Tsf = get_mu_tight_id_sf(mu2eta,leading_mu_pair.i1.pt.sum())
-            mu1Lsf = get_mu_loose_id_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Lsf = get_mu_loose_id_sf(mu2eta,leading_mu_pair.i1.pt.sum())
+            mu1Tsf = get_mu_tight_id_sf(mu1eta,leading_dimu.pt0)
+            mu2Tsf = get_mu_tight_id_sf(mu2eta,leading_dimu.pt1)
+            mu1Lsf = get_mu_loose_id_sf(mu1eta,leading_dimu.pt0)
+            mu2Lsf = get_mu_loose_id_sf(mu2eta,leading_dimu.pt1)
     
-            e1Tsf  = get_ele_tight_id_sf(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Tsf  = get_ele_tight_id_sf(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
-            e1Lsf  = get_ele_loose_id_sf(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Lsf  = get_ele_loose_id_sf(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            e1Tsf  = get_ele_tight_id_sf(leading_diele.eta0,leading_diele.pt0)
+            e2Tsf  = get_ele_tight_id_sf(leading_diele.eta1,leading_diele.pt1)
+            e1Lsf  = get_ele_loose_id_sf(leading_diele.eta0,leading_diele.pt0)
+            e2Lsf  = get_ele_loose_id_sf(leading_diele.eta1,leading_diele.pt1)
 
-            e1Teff= get_ele_tight_id_eff(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Teff= get_ele_tight_id_eff(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
-            e1Leff= get_ele_loose_id_eff(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2Leff= get_ele_loose_id_eff(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            e1Teff= get_ele_tight_id_eff(leading_diele.eta0,leading_diele.pt0)
+            e2Teff= get_ele_tight_id_eff(leading_diele.eta1,leading_diele.pt1)
+            e1Leff= get_ele_loose_id_eff(leading_diele.eta0,leading_diele.pt0)
+            e2Leff= get_ele_loose_id_eff(leading_diele.eta1,leading_diele.pt1)
 
             # Need Help from  Matteo
             ids={}
@@ -751,8 +752,8 @@ class AnalysisProcessor(processor.ProcessorABC):
             # Reconstruction weights for electrons
             ###
             
-            e1sf_reco = get_ele_reco_sf(leading_ele_pair.i0.eta.sum(),leading_ele_pair.i0.pt.sum())
-            e2sf_reco = get_ele_reco_sf(leading_ele_pair.i1.eta.sum(),leading_ele_pair.i1.pt.sum())
+            e1sf_reco = get_ele_reco_sf(leading_diele.eta0,leading_diele.pt0)
+            e2sf_reco = get_ele_reco_sf(leading_diele.eta1,leading_diele.pt1)
             
             # Need Help from  Matteo 
 
@@ -770,10 +771,10 @@ class AnalysisProcessor(processor.ProcessorABC):
             # Isolation weights for muons
             ###
 
-            mu1Tsf_iso = get_mu_tight_iso_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Tsf_iso = get_mu_tight_iso_sf(mu2eta,leading_mu_pair.i1.pt.sum())
-            mu1Lsf_iso = get_mu_loose_iso_sf(mu1eta,leading_mu_pair.i0.pt.sum())
-            mu2Lsf_iso = get_mu_loose_iso_sf(mu2eta,leading_mu_pair.i1.pt.sum())
+            mu1Tsf_iso = get_mu_tight_iso_sf(mu1eta,leading_dimu.pt0)
+            mu2Tsf_iso = get_mu_tight_iso_sf(mu2eta,leading_dimu.pt1)
+            mu1Lsf_iso = get_mu_loose_iso_sf(mu1eta,leading_dimu.pt0)
+            mu2Lsf_iso = get_mu_loose_iso_sf(mu2eta,leading_dimu.pt1)
 
             # Need Help from  Matteo 
 
@@ -796,11 +797,12 @@ class AnalysisProcessor(processor.ProcessorABC):
             btagUp = {}
             btagDown = {}
             # Need Help from  Matteo  
-            btag['sr'],   btagUp['sr'],   btagDown['sr']   = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['wmcr'], btagUp['wmcr'], btagDown['wmcr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['tmcr'], btagUp['tmcr'], btagDown['tmcr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'-1')
-            btag['wecr'], btagUp['wecr'], btagDown['wecr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
-            btag['tecr'], btagUp['tecr'], btagDown['tecr'] = get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'-1')
+            btag_tags = get_deepflav_weights['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour)
+            btag['sr'],   btagUp['sr'],   btagDown['sr']   = btag_tags['0']
+            btag['wmcr'], btagUp['wmcr'], btagDown['wmcr'] = btag_tags['0']
+            btag['tmcr'], btagUp['tmcr'], btagDown['tmcr'] = btag_tags['-1']
+            btag['wecr'], btagUp['wecr'], btagDown['wecr'] = btag_tags['0']
+            btag['tecr'], btagUp['tecr'], btagDown['tecr'] = btag_tags['-1']
             btag['zmcr'], btagUp['zmcr'], btagDown['zmcr'] = np.ones(events.size), np.ones(events.size), np.ones(events.size)#get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
             btag['zecr'], btagUp['zecr'], btagDown['zecr'] = np.ones(events.size), np.ones(events.size), np.ones(events.size)#get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
             btag['gcr'],  btagUp['gcr'],  btagDown['gcr']  = np.ones(events.size), np.ones(events.size), np.ones(events.size)#get_deepflav_weight['loose'](j_iso.pt,j_iso.eta,j_iso.hadronFlavour,'0')
@@ -812,7 +814,7 @@ class AnalysisProcessor(processor.ProcessorABC):
                 #weights[r].add('adhoc',adhoc)
                 #weights[r].add('nnlo',nnlo)
                 weights[r].add('nnlo_nlo',nnlo_nlo)
-                weights[r].add('pileup',pu)#,puUp,puDown)
+                weights[r].add('pileup',pu,puUp,puDown)
                 weights[r].add('trig', trig[r])
                 weights[r].add('ids', ids[r])
                 weights[r].add('reco', reco[r])
@@ -871,14 +873,14 @@ class AnalysisProcessor(processor.ProcessorABC):
         selection.add('istwoM', 
                       #(e_nloose==0)&(mu_ntight>=1)&(mu_nloose==2)&(tau_nloose==0)&(pho_nloose==0)
                       (e_nloose==0)&(mu_nloose==2)&(tau_nloose==0)&(pho_nloose==0)
-                      &(leading_dimu.mass.sum()>60)&(leading_dimu.mass.sum()<120)
-                      &(leading_dimu.pt.sum()>200)
+                      &(leading_dimu.mass>60)&(leading_dimu.mass<120)
+                      &(leading_dimu.pt>200)
                   )
         selection.add('istwoE', 
                       #(e_ntight>=1)&(e_nloose==2)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
                       (e_nloose==2)&(mu_nloose==0)&(tau_nloose==0)&(pho_nloose==0)
-                      &(leading_diele.mass.sum()>60)&(leading_diele.mass.sum()<120)
-                      &(leading_diele.pt.sum()>200)
+                      &(leading_diele.mass>60)&(leading_diele.mass<120)
+                      &(leading_diele.pt>200)
                   )
         selection.add('isoneA', 
                       (e_nloose==0)&(mu_nloose==0)&(tau_nloose==0)&(pho_ntight==1)
@@ -909,6 +911,8 @@ class AnalysisProcessor(processor.ProcessorABC):
         regions=temp
         temp={}
         
+        systematic_histograms = self._common['systematic_histograms']
+
         def fill(dataset, region, systematic, gentype, weight, cut):
             sname = 'nominal' if systematic is None else systematic
             variables = {}
@@ -919,13 +923,13 @@ class AnalysisProcessor(processor.ProcessorABC):
             variables['e1pt']      = leading_e.pt
             variables['e1phi']     = leading_e.phi
             variables['e1eta']     = leading_e.eta
-            variables['dielemass'] = leading_diele.mass
-            variables['dielept']   = leading_diele.pt
+            variables['dielemass'] = np.where(leading_diele.idx0>=0, leading_diele.mass, np.nan)
+            variables['dielept']   = np.where(leading_diele.idx0>=0, leading_diele.pt, np.nan)
             variables['mu1pt']     = leading_mu.pt
             variables['mu1phi']    = leading_mu.phi
             variables['mu1eta']    = leading_mu.eta
-            variables['dimumass']  = leading_dimu.mass
-            variables['dimupt']    = leading_dimu.pt
+            variables['dimumass']  = np.where(leading_dimu.idx0>=0, leading_dimu.mass, np.nan)
+            variables['dimupt']    = np.where(leading_dimu.idx0>=0, leading_dimu.pt, np.nan)
             variables['njets']     = j_nclean
             variables['ndcsvL']    = j_ndcsvL
             variables['ndflvL']    = j_ndflvL
@@ -937,12 +941,14 @@ class AnalysisProcessor(processor.ProcessorABC):
                     continue
                 elif histname == 'sumw':
                     continue
+                elif histname not in systematic_histograms.get(sname, [histname]):
+                    continue
                 elif histname == 'recoil':
                     h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, recoil=u[region.split('_')[0]].mag, weight=weight*cut)
                 elif histname == 'CaloMinusPfOverRecoil':
                     h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, CaloMinusPfOverRecoil= abs(calomet.pt - met.pt) / u[region.split('_')[0]].mag, weight=weight*cut)
                 elif histname == 'mindphi':
-                    h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, mindphi=abs(u[region.split('_')[0]].delta_phi(j_clean.T)).min(), weight=weight*cut)
+                    h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, mindphi=u_mindphi[region.split('_')[0]], weight=weight*cut)
                 else:
                     flat_variable = {histname: flat_variables[histname]}
                     h.fill(dataset=dataset, region=region, systematic=sname, gentype=gentype, **flat_variable, weight=flat_weights[histname])
@@ -956,6 +962,8 @@ class AnalysisProcessor(processor.ProcessorABC):
             None,
             'btagUp',
             'btagDown',
+            'pileupUp',
+            'pileupDown',
         ]
 
         if isData: